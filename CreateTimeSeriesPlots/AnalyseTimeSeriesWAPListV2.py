@@ -20,18 +20,37 @@ c) monthly water use statistics.
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas, seaborn, matplotlib and datetime modules
+2. Have installed the pandas, numpy, numba, bottleneck, requests, seaborn, matplotlib and datetime modules
 (NB: these come packaged with the Anaconda distribution of Python).
 """
 
 import pandas as pd
+import numpy as np
+import bottleneck as bn
 import seaborn as sns
 import datetime as dt
+import math
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from hilltoppy import web_service as ws
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 import os.path
 
+# Measurement types that hold water use volumes
+_KEEP_MEAS = frozenset({'Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'})
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+
+# Reuse one keep-alive HTTP session for every Hilltop request
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+ws.requests.get = SESSION.get
+
 
 def get_filename():
     """Prompts the user to enter the name of the csv file containing a list
@@ -49,9 +68,9 @@ def get_filename():
 def read_csv(filename):
     """Reads the contents of a given csv file, that contains a list of WAP
     datasets"""
-    infile = open(filename)
-    lines = infile.readlines()
-    infile.close()
+    wap_list = pd.read_csv(filename, header=None, usecols=[0], dtype=str).iloc[:, 0]
+    # Strip whitespace and drop repeated WAPs so each is processed once
+    lines = wap_list.str.strip().drop_duplicates().tolist()
     return lines
 
 
@@ -70,152 +89,226 @@ def get_export_response():
 def get_measurement_list(site):
     """Extracts the measurement types that are available in the Hilltop WaterUse.hts file
     for a given site"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    raw_list = ws.measurement_list(base_url, hts, site)
+    raw_list = ws.measurement_list(BASE_URL, HTS, site)
     raw_list2 = raw_list.reset_index()    
-    filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(['Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'])]
+    filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(_KEEP_MEAS)]
     return filtered_list
 
 
 def process_measurement_list(dataframe):
     """This function prepares the measurement list so that it can be used to 
     extract water use data"""
-    processed_list = dataframe.copy()
-    # Add a default start date is start date is null
-    if processed_list['From'].isnull().values.any():
-        processed_list['From'] = processed_list['From'].fillna(pd.Timestamp('2000-01-01 00:00:00'))
-    # Order by start date
-    processed_list2 = processed_list.sort_values(by=['From'], ascending=True).reset_index(drop=True)
+    # Add a default start date if start date is null and order by start date
+    processed_list2 = (dataframe.assign(From=dataframe['From'].fillna(pd.Timestamp('2000-01-01 00:00:00')))
+                       .sort_values(by=['From'], ascending=True).reset_index(drop=True))
     # Add date attributes
     processed_list2['FromDate'] = processed_list2['From'].dt.date
     processed_list2['ToDate'] = processed_list2['To'].dt.date
     return processed_list2
 
 
+def fetch_water_use_data(site, measurement, from_d, to_d):
+    """This function extracts water use data from Hilltop for a single
+    measurement type and date range. None is returned if there is no data in
+    the date range, any other error is raised to the caller."""
+    try:
+        tsdata = ws.get_data(BASE_URL, HTS, site, measurement, from_date=str(from_d), to_date=str(to_d))
+    except ValueError:
+        return None
+    return tsdata.reset_index().drop(columns='Site')
+
+
+def _year_chunks(from_d, to_d):
+    """This function splits a date range into calendar year chunks. Every chunk
+    but the last runs to the final second of the year so no data is lost between
+    chunks"""
+    chunk_from = from_d
+    while chunk_from.year < to_d.year:
+        yield chunk_from, dt.datetime(chunk_from.year, 12, 31, 23, 59, 59)
+        chunk_from = dt.date(chunk_from.year + 1, 1, 1)
+    yield chunk_from, to_d
+
+
 def extract_water_use_data(dataframe, site):
     """This function iterates through a measurement list, extracting water use
     data from Hilltop, and compiling it into a dataframe"""
-    # Set base parameters
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'    
-    # Create empty dataframe to append raw data into
-    raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     # Find the start date of the time series
     from_d = dataframe['FromDate'].iloc[0]
-    # Iterate through measurement list, extracting data and compiling
-    for index, row in dataframe.iterrows():
-        measurement = row['Measurement']
-        to_d = row['ToDate']
+    # Iterate through measurement list, working out the date range for each extraction
+    extractions = []
+    for row in dataframe[['Measurement','ToDate']].itertuples(index=False):
+        measurement, to_d = row.Measurement, row.ToDate
         if from_d <= to_d:
-            try:
-                print("Extracting {0} data from {1} to {2}".format(measurement, from_d, to_d))
-                tsdata = ws.get_data(base_url, hts, site, measurement, from_date=str(from_d), to_date=str(to_d))
-                tsdata2 = tsdata.reset_index().drop(columns='Site')
-                raw_data = pd.concat([raw_data, tsdata2], ignore_index=True)
-                # Adjust start date to prevent overlapping time series
-                from_d = to_d + dt.timedelta(days=1)
-            except:
-                print('No data extracted for:', measurement)
-                from_d = to_d + dt.timedelta(days=1)
+            print("Extracting {0} data from {1} to {2}".format(measurement, from_d, to_d))
+            extractions.append((measurement, list(_year_chunks(from_d, to_d))))
+            # Adjust start date to prevent overlapping time series
+            from_d = to_d + dt.timedelta(days=1)
         else:
             print('Skipping extraction for:', measurement)
+    # Extract the data concurrently in yearly chunks, compiling it in chronological order
+    frames = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [(m, [executor.submit(fetch_water_use_data, site, m, f, t) for f, t in chunks])
+                   for m, chunks in extractions]
+        for measurement, chunk_futures in futures:
+            # Skip the whole measurement if any chunk fails, so no years are silently lost
+            try:
+                chunk_frames = [future.result() for future in chunk_futures]
+            except Exception:
+                print('Extraction failed for:', measurement)
+                continue
+            chunk_frames = [tsdata2 for tsdata2 in chunk_frames if tsdata2 is not None]
+            if chunk_frames:
+                frames.extend(chunk_frames)
+            else:
+                print('No data extracted for:', measurement)
+    if frames:
+        raw_data = pd.concat(frames, ignore_index=True, copy=False)
+    else:
+        raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     return raw_data
 
 
 def convert_water_use_data(dataframe):
     """This function creates a common unit for all the water use data
-    (volume extracted in cubic metres)."""
-    vol_data = dataframe.copy()
+    (volume extracted in cubic metres). The dataframe is updated in place."""
+    vol_data = dataframe
+    # Store measurement types as an ordered category so comparisons use codes
+    vol_data['Measurement'] = vol_data['Measurement'].astype('category').cat.as_ordered()
     # Add date variable
-    vol_data['Date'] = vol_data['DateTime'].dt.date
-    # Convert water meter data to volume
-    vol_data.loc[vol_data['Measurement'] == 'Water Meter', 'Vol'] = vol_data.Value.diff()
-    # Leave other measurement types as they are already in the correct unit
-    vol_data.loc[vol_data['Measurement'] != 'Water Meter', 'Vol'] = vol_data.Value    
+    vol_data['Date'] = vol_data['DateTime'].dt.normalize()
+    # Convert water meter data to volume and leave other measurement types as
+    # they are already in the correct unit
+    is_meter = (vol_data['Measurement'] == 'Water Meter').to_numpy()
+    vol_data['Vol'] = np.where(is_meter, vol_data['Value'].diff().to_numpy(), vol_data['Value'].to_numpy())
     return vol_data
 
 
 def summarise_negative_values(dataframe):
     """This function analyses any negative values in the water use dataset"""
     # Find negative values
-    neg_filter = dataframe[dataframe['Vol'] < 0]
-    neg_data = neg_filter.copy()
+    neg_filter = dataframe['Vol'] < 0
+    neg_vol = dataframe.loc[neg_filter, 'Vol']
     #Add extra time variables
-    neg_data['Year'] = neg_data['DateTime'].dt.year
-    neg_data['MonthVal'] = neg_data['DateTime'].dt.month 
-    neg_data['MonthVal2'] = neg_data['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    neg_data['Month'] = neg_data['Year'].astype(str) + "-" + neg_data['MonthVal2'].astype(str)
+    neg_month = dataframe.loc[neg_filter, 'DateTime'].dt.strftime('%Y-%m').rename('Month')
     # Summarise negative values by month
-    neg_monthly = neg_data.groupby(['Month'])['Vol'].agg(['count', 'sum']).rename(columns={
+    neg_monthly = neg_vol.groupby(neg_month, sort=False, observed=True).agg(['count', 'sum']).rename(columns={
         'count':'Negative Value Count', 'sum':'Negative Value Sum'})
     return neg_monthly
 
 
 def remove_negative_values(dataframe):
-    """This function removes negative values from the water use dataset"""
-    vol_data2 = dataframe[dataframe['Vol'] >= 0]
-    return vol_data2
+    """This function removes negative values from the water use dataset. The
+    rows are dropped in place."""
+    dataframe.drop(dataframe.index[~(dataframe['Vol'] >= 0)], inplace=True)
+    return dataframe
+
+
+@njit(cache=True)
+def _welford_nonzero(vol):
+    """This function calculates the count, mean and standard deviation of the
+    volumes greater than zero in a single pass (Welford's algorithm)"""
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(vol.shape[0]):
+        x = vol[i]
+        if x > 0:
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+    if n == 0:
+        return n, np.nan, np.nan
+    if n < 2:
+        return n, mean, np.nan
+    return n, mean, (m2 / (n - 1)) ** 0.5
 
 
 def calculate_spike_parameters(dataframe):
     """This function calculates measures of central tendency that will be used
     to detect spikes"""
-    # Filter out rows where extraction is greater than zero
-    nonzero_vol = dataframe[dataframe.Vol > 0]
-    # Calculate mean and standard deviation
-    mean = nonzero_vol['Vol'].mean()
-    sd = nonzero_vol['Vol'].std()
+    # Calculate mean and standard deviation of the volumes greater than zero
+    _, mean, sd = _welford_nonzero(dataframe['Vol'].to_numpy(dtype=float))
     return mean, sd
 
 
-def detect_spikes(dataframe, mean, sd):
+@njit(cache=True)
+def _daily_kernel(codes, vol, meas_codes, n_dates, t5, t10, t20):
+    """This function counts the readings, spikes and highest measurement type
+    for each date in a single pass over the water use data"""
+    cnt = np.zeros(n_dates, np.int64)
+    s5 = np.zeros(n_dates, np.int64)
+    s10 = np.zeros(n_dates, np.int64)
+    s20 = np.zeros(n_dates, np.int64)
+    mx = np.full(n_dates, -1, np.int64)
+    for i in range(codes.shape[0]):
+        c = codes[i]
+        v = vol[i]
+        if meas_codes[i] > mx[c]:
+            mx[c] = meas_codes[i]
+        if np.isnan(v):
+            continue
+        cnt[c] += 1
+        if v > t5:
+            s5[c] += 1
+        if v > t10:
+            s10[c] += 1
+        if v > t20:
+            s20[c] += 1
+    return cnt, s5, s10, s20, mx
+
+
+def generate_daily_stats(dataframe, mean, sd):
     """This function identifies spikes (extreme values of water extraction) and
-    adds flags to the water use dataset"""
-    vol_stats = dataframe.copy()
-    # Add spike columns to dataframe
-    vol_stats['sd5'] = 0  
-    vol_stats['sd10'] = 0
-    vol_stats['sd20'] = 0
-    # Add flags if a single value is classified as a spike
-    if sd >=1 and len(vol_stats) > 100:
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 5, 'sd5'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 10, 'sd10'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 20, 'sd20'] = 1 
-    return vol_stats
-
-
-def generate_daily_stats(dataframe):
-    """This function generates daily water use statistics"""
-    # Aggregate by date
-    daily_stats = dataframe.groupby('Date').agg({'Measurement':'max',
-                                                 'Vol':'count',
-                                                 'sd5':'sum',
-                                                 'sd10':'sum',
-                                                 'sd20':'sum'})
+    generates daily water use statistics"""
+    # Only flag spikes if there is enough variation and data
+    if sd >=1 and len(dataframe) > 100:
+        t5, t10, t20 = mean + sd * 5, mean + sd * 10, mean + sd * 20
+    else:
+        t5 = t10 = t20 = np.inf
+    # Number the dates in order and aggregate by date
+    codes, dates = pd.factorize(dataframe['Date'], sort=True)
+    meas = dataframe['Measurement']
+    cnt, s5, s10, s20, mx = _daily_kernel(codes.astype(np.int64), dataframe['Vol'].to_numpy(dtype=float),
+                                          meas.cat.codes.to_numpy(dtype=np.int64), len(dates),
+                                          float(t5), float(t10), float(t20))
+    daily_stats = pd.DataFrame({'Date':dates,
+                                'Measurement':pd.Categorical.from_codes(mx, dtype=meas.dtype),
+                                'Vol':cnt,
+                                'sd5':s5,
+                                'sd10':s10,
+                                'sd20':s20})
     # Add extra time variables
-    daily_stats = daily_stats.reset_index().rename(columns={'index':'Date'})
-    daily_stats['Datetime'] = pd.to_datetime(daily_stats['Date'])
-    daily_stats['Year'] = daily_stats['Datetime'].dt.year
-    daily_stats['MonthVal'] = daily_stats['Datetime'].dt.month 
-    daily_stats['MonthVal2'] = daily_stats['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_stats['Month'] = daily_stats['Year'].astype(str) + "-" + daily_stats['MonthVal2'].astype(str)
+    daily_stats['Month'] = daily_stats['Date'].dt.strftime('%Y-%m')
     return daily_stats
     
 
+def _group_sum(values, index):
+    """This function sums the values in a group (used with the numba engine)"""
+    return np.nansum(values)
+
+
+def _group_count(values, index):
+    """This function counts the non-missing values in a group (used with the numba engine)"""
+    return np.sum(~np.isnan(values))
+
+
 def generate_monthly_stats(dataframe):
     """This function generates monthly water use statistics"""
-    # Aggregate by month
-    monthly_stats = dataframe.groupby('Month').agg({'Measurement':'max',
-                                                    'Vol':['count','sum'],
-                                                    'sd5':'sum',
-                                                    'sd10':'sum',
-                                                    'sd20':'sum'})
-    # Rename columns
-    monthly_stats.columns = ['_'.join(col) for col in monthly_stats.columns]
-    monthly_stats.rename(columns={'Measurement_max': 'MeasType', 'Vol_count':'DaysWithData',
-                                  'Vol_sum':'TotalReports', 'sd5_sum':'Spikes > 5sd','sd10_sum':'Spikes > 10sd',
-                                  'sd20_sum':'Spikes > 20sd'}, inplace=True)       
+    # Aggregate by month, using compiled parallel reductions for the numeric columns
+    grouped = dataframe.groupby('Month', sort=False, observed=True)
+    numba_kwargs = {'nopython':True, 'parallel':True}
+    monthly_stats = pd.DataFrame({
+        'MeasType':grouped['Measurement'].max(),
+        'DaysWithData':grouped['Vol'].agg(_group_count, engine='numba', engine_kwargs=numba_kwargs),
+        'TotalReports':grouped['Vol'].agg(_group_sum, engine='numba', engine_kwargs=numba_kwargs),
+        'Spikes > 5sd':grouped['sd5'].agg(_group_sum, engine='numba', engine_kwargs=numba_kwargs),
+        'Spikes > 10sd':grouped['sd10'].agg(_group_sum, engine='numba', engine_kwargs=numba_kwargs),
+        'Spikes > 20sd':grouped['sd20'].agg(_group_sum, engine='numba', engine_kwargs=numba_kwargs)})
+    # The numba engine returns floats, so restore the integer counts
+    monthly_stats = monthly_stats.astype({'DaysWithData':np.int64, 'TotalReports':np.int64, 'Spikes > 5sd':np.int64,
+                                          'Spikes > 10sd':np.int64, 'Spikes > 20sd':np.int64})
     return monthly_stats
 
 
@@ -226,14 +319,11 @@ def generate_extraction_stats(dataframe):
     extraction_data = nonzero_vol.copy()
     if len(extraction_data) >=1:
         # Add extra time variables
-        extraction_data['Year'] = extraction_data['DateTime'].dt.year
-        extraction_data['MonthVal'] = extraction_data['DateTime'].dt.month 
-        extraction_data['MonthVal2'] = extraction_data['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-        extraction_data['Month'] = extraction_data['Year'].astype(str) + "-" + extraction_data['MonthVal2'].astype(str)    
+        extraction_data['Month'] = extraction_data['DateTime'].dt.strftime('%Y-%m')
         # Convert the volume readings to a numeric datatype
         extraction_data['Vol'] = extraction_data['Vol'].apply(pd.to_numeric)
         # Calculate monthly extraction stats
-        extraction_monthly = extraction_data.groupby('Month').agg({'Vol':['min','mean','max']})
+        extraction_monthly = extraction_data.groupby('Month', sort=False, observed=True).agg({'Vol':['min','mean','max']})
         # Rename columns
         extraction_monthly.columns = ['_'.join(col) for col in extraction_monthly.columns]
         extraction_monthly.rename(columns={'Vol_min':'MinExtraction', 'Vol_mean':'MeanExtraction', 'Vol_max':'MaxExtraction'}, inplace=True)     
@@ -257,21 +347,39 @@ def combine_monthly_stats(dataframe1, dataframe2):
     return monthly_stats2
 
 
+def write_sheet(writer, dataframe, sheet_name):
+    """This function writes a dataframe and its index to a new worksheet one row
+    at a time, as required by xlsxwriter's constant_memory mode"""
+    worksheet = writer.book.add_worksheet(sheet_name)
+    header_format = writer.book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    # Show the time of day in datetime columns, plain dates use the workbook default
+    datetime_format = writer.book.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    formats = [datetime_format if pd.api.types.is_datetime64_any_dtype(dtype) else None
+               for dtype in dataframe.dtypes]
+    # Write column headings
+    worksheet.write(0, 0, dataframe.index.name, header_format)
+    worksheet.write_row(0, 1, list(dataframe.columns), header_format)
+    # Write the index and values row by row
+    for row_num, row in enumerate(dataframe.itertuples(), start=1):
+        worksheet.write(row_num, 0, row[0], header_format)
+        for col_num, (value, cell_format) in enumerate(zip(row[1:], formats), start=1):
+            worksheet.write(row_num, col_num, None if pd.isna(value) else value, cell_format)
+    return worksheet
+
+
 def export_monthly_stats(measurements, statistics, neg_summary, site):
     """This function exports water use statistics to Excel"""
-    # Create Excel file
-    writer = pd.ExcelWriter(site.replace('/','-') + ' - Summary Stats.xlsx', engine='xlsxwriter')
+    # Create Excel file, streaming rows to disk as they are written
+    writer = pd.ExcelWriter(site.replace('/','-') + ' - Summary Stats.xlsx', engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'}})
     # Export measurement list
-    measurements.to_excel(writer, sheet_name='HilltopMeasurements')
-    worksheet = writer.sheets['HilltopMeasurements']
+    worksheet = write_sheet(writer, measurements, 'HilltopMeasurements')
     worksheet.set_column('B:I', 20)
     # Export summary of negative values
-    neg_summary.to_excel(writer, sheet_name='NegativesRemoved')
-    worksheet = writer.sheets['NegativesRemoved']
+    worksheet = write_sheet(writer, neg_summary, 'NegativesRemoved')
     worksheet.set_column('B:D', 20)      
     # Export monthly statistics
-    statistics.to_excel(writer, sheet_name='MonthlyStatistics')
-    worksheet = writer.sheets['MonthlyStatistics']
+    worksheet = write_sheet(writer, statistics, 'MonthlyStatistics')
     worksheet.set_column('A:A', 10)
     worksheet.set_column('B:B', 20)
     worksheet.set_column('C:J', 15)
@@ -283,7 +391,7 @@ def process_plot_data(dataframe):
     """This function calculates daily totals, adds in any days that are missing data and gets the
     dataframe ready for plotting"""
     # Aggregate data by day
-    daily_counts = dataframe.groupby(['Date'])['Vol'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'})
+    daily_counts = dataframe.groupby(['Date'], sort=False, observed=True)['Vol'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'})
     # Find first and last dates
     from_date = dataframe['Date'].min()
     to_date = dataframe['Date'].max()
@@ -299,83 +407,75 @@ def process_plot_data(dataframe):
     daily_counts2 = daily_counts.reindex(idx)
     daily_counts2 = daily_counts2.reset_index().rename(columns={'index':'Date'})
     # Add extra date attributes
-    daily_counts2['Year'] = daily_counts2['Date'].dt.year
-    daily_counts2['MonthVal'] = daily_counts2['Date'].dt.month 
-    daily_counts2['MonthVal2'] = daily_counts2['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_counts2['Month'] = daily_counts2['Year'].astype(str) + "-" + daily_counts2['MonthVal2'].astype(str)
+    daily_counts2['Month'] = daily_counts2['Date'].dt.strftime('%Y-%m')
     daily_counts2['Day'] = daily_counts2['Date'].dt.day
     # Derive extraction rate in L/s
     daily_counts2['Rate'] = daily_counts2['Volume'] * (1000/86400)  
     # Derive 30 day rolling average
-    daily_counts2['MA30'] = daily_counts2.Volume.rolling(window=30, min_periods=21).mean()
+    daily_counts2['MA30'] = bn.move_mean(daily_counts2['Volume'].to_numpy(dtype=float), window=30, min_count=21)
     # Set missing reading counts to 0
     daily_counts2['Readings'].fillna(value=0, inplace=True)    
     return daily_counts2
     
 
+def plot_monthly_grid(groups, column, colors, title, pp, bar=False):
+    """This function plots a daily variable on a grid with one panel per month
+    and saves the figure to the pdf file"""
+    grid_count = len(groups)
+    ncols = min(grid_count, 12)
+    nrows = math.ceil(grid_count / 12)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(ncols * 1.5, nrows * 1.5),
+                             sharex=True, sharey=True, squeeze=False)
+    axes = axes.flatten()
+    # Draw each month in its own panel
+    for i, (month, month_data) in enumerate(groups):
+        ax = axes[i]
+        if bar:
+            ax.bar(month_data['Day'], month_data[column], color=colors[i])
+        else:
+            ax.plot(month_data['Day'], month_data[column], color=colors[i])
+        ax.set_title('Month = {}'.format(month))
+        if i % ncols == 0:
+            ax.set_ylabel(column)
+        if i + ncols >= grid_count:
+            ax.set_xlabel('Day')
+    # Hide any unused panels at the end of the grid
+    for ax in axes[grid_count:]:
+        ax.set_visible(False)
+    fig.tight_layout(w_pad=1)
+    if grid_count <= 12:
+        fig.subplots_adjust(top=0.7)
+    elif grid_count > 12 and grid_count <= 24:
+        fig.subplots_adjust(top=0.8)
+    else:
+        fig.subplots_adjust(top=0.9)
+    fig.suptitle(title)
+    fig.savefig(pp, format='pdf')
+    plt.close(fig)
+
+
 def generate_daily_plots(dataframe, site):
     """This function generates the daily plots and outputs them to a pdf file"""
     # Open pdf
     filename = site.replace('/','-') + ' - Time Series Plots'
     pp = PdfPages(filename + '.pdf')
-    # Calculate months in dataframe
-    grid_count = dataframe['Month'].nunique()
-    # Create bar plot of daily readings
-    daily_report_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5)
-    daily_report_grid.map(plt.bar, "Day", "Readings")
-    daily_report_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
+    # Group the data by month once and share the groups across all the plots
+    groups = list(dataframe.groupby('Month', sort=False, observed=True))
+    grid_count = len(groups)
+    # Pick one colour per month
+    if grid_count <= len(sns.color_palette()):
+        colors = sns.color_palette(n_colors=grid_count)
     else:
-        plt.subplots_adjust(top=0.9)
-    daily_report_grid.fig.suptitle('Meter readings received (daily)')
-    daily_report_grid.savefig(pp, format='pdf')
-    plt.close()
+        colors = sns.color_palette('husl', grid_count)
+    # Create bar plot of daily readings
+    plot_monthly_grid(groups, 'Readings', colors, 'Meter readings received (daily)', pp, bar=True)
     # Create line plot of daily volumes
-    daily_vol_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_vol_grid.map(plt.plot, "Day", "Volume")
-    daily_vol_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_vol_grid.fig.suptitle('Daily volume extracted in m3')
-    daily_vol_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(groups, 'Volume', colors, 'Daily volume extracted in m3', pp)
     # Create line plot of 30 day moving average
-    daily_ma30_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_ma30_grid.map(plt.plot, "Day", "MA30")
-    daily_ma30_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_ma30_grid.fig.suptitle('Volume extracted (m3) - 30 day moving average (21 days required)')
-    daily_ma30_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(groups, 'MA30', colors, 'Volume extracted (m3) - 30 day moving average (21 days required)', pp)
     # Create line plot of daily extraction rates
-    daily_rate_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_rate_grid.map(plt.plot, "Day", "Rate")
-    daily_rate_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_rate_grid.fig.suptitle('Average daily extraction rate in L/s')
-    daily_rate_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(groups, 'Rate', colors, 'Average daily extraction rate in L/s', pp)
+    
     # Close pdf
     pp.close()    
     
@@ -391,8 +491,7 @@ def main():
     export_response = get_export_response()
     
     ## Iterate through site list
-    for wap in site_list:
-        site = wap.rstrip("\n")
+    for site in site_list:
         print("")
         print("Processing {}".format(site))
         try:
@@ -415,10 +514,8 @@ def main():
                 print("Calculating monthly statistics")
                 # Calculate spike detection parameters
                 mean, sd = calculate_spike_parameters(vol_data2)
-                # Detect spikes
-                vol_stats = detect_spikes(vol_data2, mean, sd)
-                # Summarise water use statistics by day
-                daily_stats = generate_daily_stats(vol_stats)
+                # Detect spikes and summarise water use statistics by day
+                daily_stats = generate_daily_stats(vol_data2, mean, sd)
                 # Summarise water use statistics by month
                 monthly_stats = generate_monthly_stats(daily_stats)
                 # Summarise extraction statistics by month
@@ -20,28 +20,58 @@ c) monthly water use statistics.
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas, seaborn, matplotlib, datetime and pdsql modules
+2. Have installed the pandas, numpy, bottleneck, requests, seaborn, matplotlib, datetime, pdsql and joblib modules
 (NB: these come packaged with the Anaconda distribution of Python).
 3. Have access to the CrcActSiteSumm table, stored in the ConsentsReporting
 database, on the edwprod01 server.
 """
 
 import pandas as pd
+import numpy as np
+import bottleneck as bn
 import seaborn as sns
 import datetime as dt
+import math
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from hilltoppy import web_service as ws
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from pdsql import mssql as sq
+from functools import lru_cache
+from joblib import Memory
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+
+# Reuse one keep-alive HTTP session for every Hilltop request
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+ws.requests.get = SESSION.get
+
+# Cache Hilltop site and measurement lists on disk so that repeat runs on the same day
+# skip the network
+MEMORY = Memory('.hilltop_cache', verbose=0)
+
+
+@MEMORY.cache
+def _cached_site_list(base_url, hts, day):
+    """This function requests the site list from Hilltop. The day only forms
+    part of the cache key, so that the list is refreshed daily"""
+    return ws.site_list(base_url, hts)
 
 
 def get_site():
     """This function prompts the user to enter the WAP that they wish to generate plots for"""
+    # Fetch the site list once and keep it as a set for quick lookups
+    site_list = _cached_site_list(BASE_URL, HTS, dt.date.today().isoformat())
+    sites = frozenset(site_list.values.ravel().tolist())
     site = None
     while site is None:
         site_entry = input("Enter the WAP of interest: ")
-        site_list = ws.site_list('http://wateruse.ecan.govt.nz', 'WaterUse.hts')
-        if site_entry in site_list.values:
+        if site_entry in sites:
             site = site_entry
         else:
             print("The WAP you have entered is not in the WaterUse.hts file. Please try again.")
@@ -60,12 +90,17 @@ def get_export_response():
     return export_response
 
 
+@MEMORY.cache
+def _cached_measurement_list(base_url, hts, site, day):
+    """This function requests the measurement list for a site from Hilltop. The
+    day only forms part of the cache key, so that the list is refreshed daily"""
+    return ws.measurement_list(base_url, hts, site)
+
+
 def get_measurement_list(site):
     """Extracts the measurement types that are available in the Hilltop WaterUse.hts file
     for a given site"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    raw_list = ws.measurement_list(base_url, hts, site)
+    raw_list = _cached_measurement_list(BASE_URL, HTS, site, dt.date.today().isoformat())
     raw_list2 = raw_list.reset_index()    
     filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(['Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'])]
     return filtered_list
@@ -81,38 +116,51 @@ def process_measurement_list(dataframe):
     # Order by start date
     processed_list2 = processed_list.sort_values(by=['From'], ascending=True).reset_index(drop=True)
     # Add date attributes
-    processed_list2['FromDate'] = processed_list2['From'].dt.date
-    processed_list2['ToDate'] = processed_list2['To'].dt.date
+    processed_list2['FromDate'] = processed_list2['From'].dt.floor('D')
+    processed_list2['ToDate'] = processed_list2['To'].dt.floor('D')
     return processed_list2
 
 
+def fetch_water_use_data(site, measurement, from_d, to_d):
+    """This function extracts water use data from Hilltop for a single
+    measurement type and date range. None is returned if no data is extracted."""
+    try:
+        tsdata = ws.get_data(BASE_URL, HTS, site, measurement, from_date=from_d.strftime('%Y-%m-%d'), to_date=to_d.strftime('%Y-%m-%d'))
+        return tsdata.reset_index().drop(columns='Site')
+    except Exception:
+        print('No data extracted for:', measurement)
+        return None
+
+
 def extract_water_use_data(dataframe, site):
     """This function iterates through a measurement list, extracting water use
     data from Hilltop, and compiling it into a dataframe"""
-    # Set base parameters
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'    
-    # Create empty dataframe to append raw data into
-    raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     # Find the start date of the time series
     from_d = dataframe['FromDate'].iloc[0]
-    # Iterate through measurement list, extracting data and compiling
+    # Iterate through measurement list, working out the date range for each extraction
+    extractions = []
     for index, row in dataframe.iterrows():
         measurement = row['Measurement']
         to_d = row['ToDate']
         if from_d <= to_d:
-            try:
-                print("Extracting {0} data from {1} to {2}".format(measurement, from_d, to_d))
-                tsdata = ws.get_data(base_url, hts, site, measurement, from_date=str(from_d), to_date=str(to_d))
-                tsdata2 = tsdata.reset_index().drop(columns='Site')
-                raw_data = pd.concat([raw_data, tsdata2], ignore_index=True)
-                # Adjust start date to prevent overlapping time series
-                from_d = to_d + dt.timedelta(days=1)
-            except:
-                print('No data extracted for:', measurement)
-                from_d = to_d + dt.timedelta(days=1)
+            print("Extracting {0} data from {1:%Y-%m-%d} to {2:%Y-%m-%d}".format(measurement, from_d, to_d))
+            extractions.append((measurement, from_d, to_d))
+            # Adjust start date to prevent overlapping time series
+            from_d = to_d + dt.timedelta(days=1)
         else:
             print('Skipping extraction for:', measurement)
+    # Extract the data concurrently, compiling it in measurement list order
+    frames = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(fetch_water_use_data, site, m, f, t) for m, f, t in extractions]
+        for future in futures:
+            tsdata2 = future.result()
+            if tsdata2 is not None:
+                frames.append(tsdata2)
+    if frames:
+        raw_data = pd.concat(frames, ignore_index=True, copy=False)
+    else:
+        raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     return raw_data
 
 
@@ -121,24 +169,31 @@ def convert_water_use_data(dataframe):
     (volume extracted in cubic metres)."""
     vol_data = dataframe.copy()
     # Add date variable
-    vol_data['Date'] = vol_data['DateTime'].dt.date
-    # Convert water meter data to volume
-    vol_data.loc[vol_data['Measurement'] == 'Water Meter', 'Vol'] = vol_data.Value.diff()
-    # Leave other measurement types as they are already in the correct unit
-    vol_data.loc[vol_data['Measurement'] != 'Water Meter', 'Vol'] = vol_data.Value    
+    vol_data['Date'] = vol_data['DateTime'].to_numpy().astype('datetime64[D]')
+    # Convert water meter data to volume and leave other measurement types as
+    # they are already in the correct unit
+    values = vol_data['Value'].to_numpy(dtype=float)
+    diffed = np.empty(len(values))
+    diffed[:1] = np.nan
+    np.subtract(values[1:], values[:-1], out=diffed[1:])
+    is_meter = (vol_data['Measurement'] == 'Water Meter').to_numpy()
+    vol_data['Vol'] = np.where(is_meter, diffed, values)
     return vol_data
 
 
+def add_month_key(dataframe):
+    """This function adds an integer YYYYMM month key to the water use dataset
+    so that the monthly summaries can share it"""
+    months = dataframe['DateTime'].to_numpy().astype('datetime64[M]').astype(np.int64)
+    dataframe['Month'] = (months // 12 + 1970) * 100 + months % 12 + 1
+    return dataframe
+
+
 def summarise_negative_values(dataframe):
     """This function analyses any negative values in the water use dataset"""
     # Find negative values
     neg_filter = dataframe[dataframe['Vol'] < 0]
     neg_data = neg_filter.copy()
-    #Add extra time variables
-    neg_data['Year'] = neg_data['DateTime'].dt.year
-    neg_data['MonthVal'] = neg_data['DateTime'].dt.month 
-    neg_data['MonthVal2'] = neg_data['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    neg_data['Month'] = neg_data['Year'].astype(str) + "-" + neg_data['MonthVal2'].astype(str)
     # Summarise negative values by month
     neg_monthly = neg_data.groupby(['Month'])['Vol'].agg(['count', 'sum']).rename(columns={
         'count':'Negative Value Count', 'sum':'Negative Value Sum'})
@@ -166,15 +221,15 @@ def detect_spikes(dataframe, mean, sd):
     """This function identifies spikes (extreme values of water extraction) and
     adds flags to the water use dataset"""
     vol_stats = dataframe.copy()
-    # Add spike columns to dataframe
-    vol_stats['sd5'] = 0  
-    vol_stats['sd10'] = 0
-    vol_stats['sd20'] = 0
-    # Add flags if a single value is classified as a spike
+    # Add flags if a single value is classified as a spike, comparing every
+    # volume against the 5, 10 and 20 sd thresholds at once
     if sd >=1 and len(vol_stats) > 100:
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 5, 'sd5'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 10, 'sd10'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 20, 'sd20'] = 1 
+        thresholds = mean + sd * np.array([5, 10, 20])
+        flags = (vol_stats['Vol'].to_numpy()[:, None] > thresholds).astype(np.int8)
+    else:
+        flags = np.zeros((len(vol_stats), 3), dtype=np.int8)
+    # Add spike columns to dataframe
+    vol_stats['sd5'], vol_stats['sd10'], vol_stats['sd20'] = flags.T
     return vol_stats
 
 
@@ -185,14 +240,9 @@ def generate_daily_stats(dataframe):
                                                  'Vol':'count',
                                                  'sd5':'sum',
                                                  'sd10':'sum',
-                                                 'sd20':'sum'})
-    # Add extra time variables
+                                                 'sd20':'sum',
+                                                 'Month':'first'})
     daily_stats = daily_stats.reset_index().rename(columns={'index':'Date'})
-    daily_stats['Datetime'] = pd.to_datetime(daily_stats['Date'])
-    daily_stats['Year'] = daily_stats['Datetime'].dt.year
-    daily_stats['MonthVal'] = daily_stats['Datetime'].dt.month 
-    daily_stats['MonthVal2'] = daily_stats['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_stats['Month'] = daily_stats['Year'].astype(str) + "-" + daily_stats['MonthVal2'].astype(str)
     return daily_stats
     
 
@@ -218,13 +268,6 @@ def generate_extraction_stats(dataframe):
     nonzero_vol = dataframe[dataframe.Vol > 0]
     extraction_data = nonzero_vol.copy()
     if len(extraction_data) >=1:
-        # Add extra time variables
-        extraction_data['Year'] = extraction_data['DateTime'].dt.year
-        extraction_data['MonthVal'] = extraction_data['DateTime'].dt.month 
-        extraction_data['MonthVal2'] = extraction_data['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-        extraction_data['Month'] = extraction_data['Year'].astype(str) + "-" + extraction_data['MonthVal2'].astype(str)    
-        # Convert the volume readings to a numeric datatype
-        extraction_data['Vol'] = extraction_data['Vol'].apply(pd.to_numeric)
         # Calculate monthly extraction stats
         extraction_monthly = extraction_data.groupby('Month').agg({'Vol':['min','mean','max']})
         # Rename columns
@@ -237,53 +280,93 @@ def generate_extraction_stats(dataframe):
     else:
         # If there is no extraction data, create an empty dataframe with column headings
         column_names = ['Month', 'MinExtraction', 'MeanExtraction', 'MaxExtraction']
-        extraction_monthly = pd.DataFrame(columns = column_names)
+        extraction_monthly = pd.DataFrame(columns = column_names).astype({'Month': 'int64'}).set_index('Month')
     return extraction_monthly
 
 
 def combine_monthly_stats(dataframe1, dataframe2):
     """This function combines all the monthly statistics into one dataframe"""
-    monthly_stats2 = pd.merge(dataframe1, dataframe2, on='Month', how='left')
+    monthly_stats2 = dataframe1.join(dataframe2, how='left')
     # Change column order
     monthly_stats2 = monthly_stats2[['MeasType','DaysWithData','TotalReports','MinExtraction','MeanExtraction',
                                          'MaxExtraction','Spikes > 5sd','Spikes > 10sd','Spikes > 20sd']]
     return monthly_stats2
 
 
+def write_sheet(writer, dataframe, sheet_name):
+    """This function writes a dataframe and its index to a new worksheet one row
+    at a time, as required by xlsxwriter's constant_memory mode"""
+    worksheet = writer.book.add_worksheet(sheet_name)
+    header_format = writer.book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    # Show the time of day in datetime columns, plain dates use the workbook default
+    datetime_format = writer.book.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    formats = [datetime_format if pd.api.types.is_datetime64_any_dtype(dtype) else None
+               for dtype in dataframe.dtypes]
+    # Write column headings
+    worksheet.write(0, 0, dataframe.index.name, header_format)
+    worksheet.write_row(0, 1, list(dataframe.columns), header_format)
+    # Write the index and values row by row
+    for row_num, row in enumerate(dataframe.itertuples(), start=1):
+        worksheet.write(row_num, 0, row[0], header_format)
+        for col_num, (value, cell_format) in enumerate(zip(row[1:], formats), start=1):
+            worksheet.write(row_num, col_num, None if pd.isna(value) else value, cell_format)
+    return worksheet
+
+
+def _apply_widths(worksheet, widths):
+    """This function sets the widths of the given column ranges on a worksheet"""
+    for columns, width in widths.items():
+        worksheet.set_column(columns, width)
+
+
 def export_monthly_stats(measurements, statistics, neg_summary, site):
     """This function exports water use statistics to Excel"""
-    # Create Excel file
-    writer = pd.ExcelWriter(site.replace('/','-') + ' - Summary Stats.xlsx', engine='xlsxwriter')
-    # Export measurement list
-    measurements.to_excel(writer, sheet_name='HilltopMeasurements')
-    worksheet = writer.sheets['HilltopMeasurements']
-    worksheet.set_column('B:I', 20)
+    # Create Excel file, streaming rows to disk as they are written
+    writer = pd.ExcelWriter(site.replace('/','-') + ' - Summary Stats.xlsx', engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True, 'strings_to_numbers': False,
+                                                       'default_date_format': 'yyyy-mm-dd'}})
+    # Export measurement list, writing the start and end dates without a time
+    measurements = measurements.assign(FromDate=measurements['FromDate'].dt.date,
+                                       ToDate=measurements['ToDate'].dt.date)
+    worksheet = write_sheet(writer, measurements, 'HilltopMeasurements')
+    _apply_widths(worksheet, {'B:I': 20})
+    # Format the integer month keys as YYYY-MM labels
+    neg_summary = neg_summary.rename(index=lambda k: '%d-%02d' % divmod(k, 100))
+    statistics = statistics.rename(index=lambda k: '%d-%02d' % divmod(k, 100))
     # Export summary of negative values
-    neg_summary.to_excel(writer, sheet_name='NegativesRemoved')
-    worksheet = writer.sheets['NegativesRemoved']
-    worksheet.set_column('B:D', 20)      
+    worksheet = write_sheet(writer, neg_summary, 'NegativesRemoved')
+    _apply_widths(worksheet, {'B:D': 20})
     # Export monthly statistics
-    statistics.to_excel(writer, sheet_name='MonthlyStatistics')
-    worksheet = writer.sheets['MonthlyStatistics']
-    worksheet.set_column('A:A', 10)
-    worksheet.set_column('B:B', 20)
-    worksheet.set_column('C:J', 15)
+    worksheet = write_sheet(writer, statistics, 'MonthlyStatistics')
+    _apply_widths(worksheet, {'A:A': 10, 'B:B': 20, 'C:J': 15})
     # Save file
     writer.save()
 
 
-def get_consent_conditions(site_id):
-    """This function extracts consent conditions for a site of interest""" 
+@lru_cache(maxsize=1)
+def _load_crc_table():
+    """This function reads the table of consent conditions once and indexes it
+    by site, so that it can be reused for every WAP"""
     # Read table of consent conditions and convert to a pandas dataframe (Ecan)
     server = 'edwprod01'
     database = 'ConsentsReporting'
     table = 'reporting.CrcActSiteSumm'
     crc_table = sq.rd_sql(server, database, table)
+    return crc_table.set_index('ExtSiteID').sort_index()
+
+
+def get_consent_conditions(site_id):
+    """This function extracts consent conditions for a site of interest""" 
+    crc_table = _load_crc_table()
+    # Look up all the consents for the specified site
+    if site_id in crc_table.index:
+        all_consents = crc_table.loc[[site_id]].reset_index()
+    else:
+        all_consents = crc_table.iloc[0:0].reset_index()
     # Extract the active consents for the specified site
-    consents = crc_table.loc[(crc_table['ExtSiteID'] == site_id) & (crc_table['ConsentStatus'] == 'Issued - Active')]
+    consents = all_consents.loc[all_consents['ConsentStatus'] == 'Issued - Active']
     # If there are no active consents, extract the most recent consent for the specified site
     if len(consents) == 0:
-        all_consents = crc_table.loc[(crc_table['ExtSiteID'] == site_id)]
         most_recent = all_consents['ToDate'].max()
         consents = all_consents.loc[all_consents['ToDate'] == most_recent]
     return consents
@@ -321,10 +404,7 @@ def process_plot_data1(dataframe):
     daily_counts2 = daily_counts.reindex(idx)
     daily_counts2 = daily_counts2.reset_index().rename(columns={'index':'Date'})
     # Add extra date attributes
-    daily_counts2['Year'] = daily_counts2['Date'].dt.year
-    daily_counts2['MonthVal'] = daily_counts2['Date'].dt.month 
-    daily_counts2['MonthVal2'] = daily_counts2['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_counts2['Month'] = daily_counts2['Year'].astype(str) + "-" + daily_counts2['MonthVal2'].astype(str)
+    daily_counts2['Month'] = daily_counts2['Date'].dt.to_period('M')
     daily_counts2['Day'] = daily_counts2['Date'].dt.day
     # Derive extraction rate in L/s
     daily_counts2['Rate'] = daily_counts2['Volume'] * (1000/86400)  
@@ -354,20 +434,65 @@ def process_plot_data2(dataframe, return_period):
     daily_counts2 = daily_counts.reindex(idx)
     daily_counts2 = daily_counts2.reset_index().rename(columns={'index':'Date'})
     # Add extra date attributes
-    daily_counts2['Year'] = daily_counts2['Date'].dt.year
-    daily_counts2['MonthVal'] = daily_counts2['Date'].dt.month 
-    daily_counts2['MonthVal2'] = daily_counts2['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_counts2['Month'] = daily_counts2['Year'].astype(str) + "-" + daily_counts2['MonthVal2'].astype(str)
+    daily_counts2['Month'] = daily_counts2['Date'].dt.to_period('M')
     daily_counts2['Day'] = daily_counts2['Date'].dt.day
     # Derive extraction rate in L/s
     daily_counts2['Rate'] = daily_counts2['Volume'] * (1000/86400)  
     # Derive 30 day rolling average
-    daily_counts2['MA'] = daily_counts2.Volume.rolling(window=int(return_period)).mean()
+    window = int(return_period)
+    daily_counts2['MA'] = bn.move_mean(daily_counts2['Volume'].to_numpy(dtype=float), window=window, min_count=window)
     # Set missing reading counts to 0
     daily_counts2['Readings'].fillna(value=0, inplace=True)
     return daily_counts2
 
 
+def plot_monthly_grid(pivot, column, title, pp, bar=False, ref_line=None):
+    """This function plots a daily variable, pivoted to one column per month,
+    on a grid with one panel per month and saves the figure to the pdf file"""
+    values = pivot[column].to_numpy()
+    months = pivot[column].columns
+    days = pivot.index.to_numpy()
+    grid_count = len(months)
+    # Pick one colour per month
+    if grid_count <= len(sns.color_palette()):
+        colors = sns.color_palette(n_colors=grid_count)
+    else:
+        colors = sns.color_palette('husl', grid_count)
+    ncols = min(grid_count, 12)
+    nrows = math.ceil(grid_count / 12)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(ncols * 1.5, nrows * 1.5),
+                             sharex=True, sharey=True, squeeze=False)
+    axes = axes.flatten()
+    # Draw each month in its own panel
+    for i, month in enumerate(months):
+        ax = axes[i]
+        if bar:
+            ax.bar(days, values[:, i], color=colors[i])
+        else:
+            ax.plot(days, values[:, i], color=colors[i])
+        # Add reference line
+        if ref_line is not None:
+            ax.axhline(y=ref_line, ls='--', c='gray')
+        ax.set_title('Month = {}'.format(month))
+        if i % ncols == 0:
+            ax.set_ylabel(column)
+        if i + ncols >= grid_count:
+            ax.set_xlabel('Day')
+    # Hide any unused panels at the end of the grid
+    for ax in axes[grid_count:]:
+        ax.set_visible(False)
+    fig.tight_layout(w_pad=1)
+    if grid_count <= 12:
+        fig.subplots_adjust(top=0.7)
+    elif grid_count > 12 and grid_count <= 24:
+        fig.subplots_adjust(top=0.8)
+    else:
+        fig.subplots_adjust(top=0.9)
+    fig.suptitle(title)
+    fig.savefig(pp, format='pdf')
+    plt.close(fig)
+
+
 def generate_daily_plots1(dataframe, site):
     """This function generates the daily plots and outputs them to a pdf file.
     It is applied when there are no consent conditions that need to be taken
@@ -375,50 +500,14 @@ def generate_daily_plots1(dataframe, site):
     # Open pdf
     filename = site.replace('/','-') + ' - Time Series Plots'
     pp = PdfPages(filename + '.pdf')
-    # Calculate months in dataframe
-    grid_count = dataframe['Month'].nunique()    
+    # Pivot the data once to a day by month table shared across all the plots
+    pivot = dataframe.pivot(index='Day', columns='Month', values=['Readings', 'Volume', 'Rate']).reindex(range(1, 32))
     # Create bar plot of daily readings
-    daily_report_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5)
-    daily_report_grid.map(plt.bar, "Day", "Readings")
-    daily_report_grid.fig.tight_layout(w_pad=1)
-    if grid_count < 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count >= 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_report_grid.fig.suptitle('Meter readings received (daily)')
-    daily_report_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Readings", 'Meter readings received (daily)', pp, bar=True)
     # Create line plot of daily volumes
-    daily_vol_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_vol_grid.map(plt.plot, "Day", "Volume")
-    daily_vol_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_vol_grid.fig.suptitle('Daily volume extracted in m3')
-    daily_vol_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Volume", 'Daily volume extracted in m3', pp)
     # Create line plot of daily extraction rates
-    daily_rate_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_rate_grid.map(plt.plot, "Day", "Rate")
-    daily_rate_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_rate_grid.fig.suptitle('Average daily extraction rate in L/s')
-    daily_rate_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Rate", 'Average daily extraction rate in L/s', pp)
     # Close pdf
     pp.close()
     
@@ -430,69 +519,20 @@ def generate_daily_plots2(dataframe, site, max_rate, max_vol, multiday_vol, retu
     # Open pdf
     filename = site.replace('/','-') + ' - Time Series Plots'
     pp = PdfPages(filename + '.pdf')
-    # Calculate months in dataframe
-    grid_count = dataframe['Month'].nunique()    
+    # Pivot the data once to a day by month table shared across all the plots
+    pivot = dataframe.pivot(index='Day', columns='Month', values=['Readings', 'Volume', 'MA', 'Rate']).reindex(range(1, 32))
     # Create bar plot of daily readings
-    daily_report_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5)
-    daily_report_grid.map(plt.bar, "Day", "Readings")
-    daily_report_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_report_grid.fig.suptitle('Meter readings received (daily)')
-    daily_report_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Readings", 'Meter readings received (daily)', pp, bar=True)
     # Create line plot of daily volumes
-    daily_vol_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_vol_grid.map(plt.plot, "Day", "Volume")
-    daily_vol_grid.map(plt.axhline, y=max_vol, ls='--', c='gray')
-    daily_vol_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_vol_grid.fig.suptitle('Daily volume extracted in m3')
-    daily_vol_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Volume", 'Daily volume extracted in m3', pp,
+                      ref_line=max_vol)
     # Create line plot of extracted volume moving average
-    daily_ma_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_ma_grid.map(plt.plot, "Day", "MA")
-    ref_line = round(multiday_vol/return_period, 1)
-    daily_ma_grid.map(plt.axhline, y=ref_line, ls='--', c='gray')
-    daily_ma_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
     period = str(int(return_period))
-    daily_ma_grid.fig.suptitle('Volume extracted (m3) - {} day moving average'.format(period))
-    daily_ma_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "MA", 'Volume extracted (m3) - {} day moving average'.format(period), pp,
+                      ref_line=round(multiday_vol/return_period, 1))
     # Create line plot of daily extraction rates
-    daily_rate_grid = sns.FacetGrid(dataframe, col="Month", hue="Month",
-                    col_wrap=12, height=1.5, dropna=False)
-    daily_rate_grid.map(plt.plot, "Day", "Rate")
-    daily_rate_grid.map(plt.axhline, y=max_rate, ls='--', c='gray')
-    daily_rate_grid.fig.tight_layout(w_pad=1)
-    if grid_count <= 12:
-        plt.subplots_adjust(top=0.7)
-    elif grid_count > 12 and grid_count <= 24:
-        plt.subplots_adjust(top=0.8)
-    else:
-        plt.subplots_adjust(top=0.9)
-    daily_rate_grid.fig.suptitle('Average daily extraction rate in L/s')
-    daily_rate_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_monthly_grid(pivot, "Rate", 'Average daily extraction rate in L/s', pp,
+                      ref_line=max_rate)
     # Close pdf
     pp.close()    
     
@@ -515,6 +555,8 @@ def main():
     wu_data = extract_water_use_data(mslist2, site)
     # Convert water use data to a common unit
     vol_data = convert_water_use_data(wu_data)
+    # Add the month key used by the monthly summaries
+    vol_data = add_month_key(vol_data)
     # Summarise any negative values in the water use dataset
     neg_summary = summarise_negative_values(vol_data)
     # Remove negative values from water use dataset
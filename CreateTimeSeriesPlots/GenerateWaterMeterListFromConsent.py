@@ -12,7 +12,7 @@ Contact the developer: hamish.graham@ecan.govt.nz
 
 Inputs to the program:
 1.  The user will need to specify the folder pathway the python packages are
-    located (line 59)
+    located (line 63)
 2.  The user needs to specify the list of consents in consents.csv using the 
     heading "RecordNumber" in cell A1
 
@@ -23,7 +23,7 @@ The program will create:
 
 In order to run the program the user needs to:
 1.  Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2.  Have installed the pandas, seaborn, matplotlib, datetime and pdsql modules
+2.  Have installed the pandas, seaborn, matplotlib, datetime, pdsql and joblib modules
     (NB: these come packaged with the Anaconda distribution of Python).
 3.  Have access to the CrcActSiteSumm table, stored in the ConsentsReporting
     database, on the edwprod01 server along with the ExternalSite table,
@@ -31,11 +31,13 @@ In order to run the program the user needs to:
 
 """
 import os
+from datetime import date
 import numpy as np
 import pandas as pd
 from pdsql import mssql
 from hilltoppy import utils
 from hilltoppy import web_service as ws
+from joblib import Memory
 
 pd.options.display.max_columns = 10
 
@@ -54,6 +56,8 @@ crc_table = 'reporting.CrcActSiteSumm'
 ht_url = 'http://wateruse.ecan.govt.nz'
 url_hts = 'WaterUse.hts'
 
+memory = Memory('.hilltop_cache', verbose=0)
+
 ## Query parameters - Can change, user defined
 #Input parameters
 base_path = r'C:\Users\hamishg\OneDrive - Environment Canterbury\Documents\_Projects\git\WaterUseQA\CreateTimeSeriesPlots'
@@ -88,14 +92,17 @@ def rd_crc(where_in=None, from_date='1900-07-01', to_date='2100-06-30', include_
     """
     ### allocation
     allo1 = mssql.rd_sql(server, crc_db, crc_table, where_in=where_in)
+    allo1['ToDate'] = pd.to_datetime(allo1['ToDate'], errors='coerce')
+    allo1['FromDate'] = pd.to_datetime(allo1['FromDate'], errors='coerce')
+
+    ### Time series filtering, combined into a single mask over the datetime arrays
+    to_dates = allo1['ToDate'].to_numpy()
+    from_dates = allo1['FromDate'].to_numpy()
+    span = (to_dates - from_dates).astype('timedelta64[D]')
+    mask = (span > np.timedelta64(10, 'D')) & (from_dates < np.datetime64(to_date)) & (to_dates > np.datetime64(from_date))
     if not include_hydroelectric:
-        allo1 = allo1[allo1.WaterUse != 'hydroelectric']
-
-    ### Time series filtering
-    allo1.loc[:, 'ToDate'] = pd.to_datetime(allo1.loc[:, 'ToDate'], errors='coerce')
-    allo1.loc[:, 'FromDate'] = pd.to_datetime(allo1.loc[:, 'FromDate'], errors='coerce')
-    allo1 = allo1[(allo1['ToDate'] - allo1['FromDate']).dt.days > 10]
-    allo2 = allo1[(allo1.FromDate < to_date) & (allo1.ToDate > from_date)].copy()
+        mask &= (allo1['WaterUse'] != 'hydroelectric').to_numpy()
+    allo2 = allo1.loc[mask]
 
     # ### Index the DataFrame
     # allo2.set_index(['RecordNumber', 'HydroGroup', 'AllocationBlock', 'ExtSiteID'], inplace=True)
@@ -116,30 +123,65 @@ def rd_sites(where_in=None):
                 cols.extend([k])
     elif where_in is not None:
         raise ValueError('where_in should either be None or a dict')
-    sites = mssql.rd_sql(server, hydro_db, site_table, cols, where_in=where_in)
-    sites1 = sites[sites.ExtSiteID.str.contains('[A-Z]+\d\d/\d+')].copy()
+
+    ### Filter on the site ID pattern in SQL Server so only matching sites are returned
+    where_lst = ["ExtSiteID COLLATE Latin1_General_BIN LIKE '%[A-Z][0-9][0-9]/[0-9]%'"]
+    if isinstance(where_in, dict):
+        for k, v in where_in.items():
+            values = ', '.join("'" + str(i).replace("'", "''") + "'" for i in v)
+            where_lst.append('{} IN ({})'.format(k, values))
+    stmt = 'SELECT {} FROM {} WHERE {}'.format(', '.join(cols), site_table, ' AND '.join(where_lst))
+    sites1 = mssql.rd_sql(server, hydro_db, stmt=stmt)
 
     return sites1
 
 
+@memory.cache
+def rd_ht_sites(ht_url, url_hts, day):
+    """
+    Function to read the Hilltop site list, cached on disk so that repeat runs skip the download.
+
+    Parameters
+    ----------
+    ht_url : str
+        The Hilltop server url.
+    url_hts : str
+        The hts file name.
+    day : str
+        The date of the run, only used as part of the cache key so that the list is refreshed daily.
+
+    Returns
+    -------
+    DataFrame
+        Hilltop sites
+    """
+    return ws.site_list(ht_url, url_hts)
+
+
 ##############################################
 ### Query
 
-sites1 = pd.read_csv(csv_path)
+sites1 = pd.read_csv(csv_path, usecols=['RecordNumber'], dtype=str)
 
 crc_dict = {'RecordNumber': sites1.RecordNumber.tolist()}
 
 crc1 = rd_crc(crc_dict)
 
-ht_sites = ws.site_list(ht_url, url_hts)
+ht_sites = rd_ht_sites(ht_url, url_hts, date.today().isoformat())
 
 ht_sites['ExtSiteID'] = utils.convert_site_names(ht_sites.SiteName)
 
 ht_sites1 = ht_sites.dropna()
 
-ht_crc_wap = pd.merge(crc1, ht_sites1, on='ExtSiteID').drop_duplicates('SiteName')
+## Keep the first consent record for each WAP, so each meter only joins once
+crc_first = crc1.drop_duplicates('ExtSiteID')
+
+## Join on shared categorical codes rather than hashing the site name strings
+site_cats = pd.Index(np.union1d(crc_first['ExtSiteID'].unique(), ht_sites1['ExtSiteID'].unique()))
+crc_first = crc_first.assign(_k=pd.Categorical(crc_first['ExtSiteID'], categories=site_cats).codes)
+ht_sites1 = ht_sites1.assign(_k=pd.Categorical(ht_sites1['ExtSiteID'], categories=site_cats).codes).drop(columns='ExtSiteID')
 
-ht_waps = ht_crc_wap[['SiteName']]
+ht_crc_wap = pd.merge(crc_first, ht_sites1, on='_k', how='inner', validate='1:m', copy=False).drop(columns='_k')
 
 ################################################
 ### Export meter name table
@@ -18,25 +18,50 @@ b) volumes extracted per hour, over a 35 day period.
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas, seaborn, matplotlib and datetime modules
+2. Have installed the pandas, numpy, seaborn, matplotlib, datetime and joblib modules
 (NB: these come packaged with the Anaconda distribution of Python).
 """
 
 import pandas as pd
+import numpy as np
 import seaborn as sns
 import datetime as dt
+import math
+import matplotlib
+# Render plots without a display, as they are only written to pdf
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from hilltoppy import web_service as ws
+from joblib import Memory
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+
+# Cache Hilltop site and measurement lists on disk so that repeat runs on the same day
+# skip the network
+MEMORY = Memory('.hilltop_cache', verbose=0)
+
+
+@MEMORY.cache
+def _cached_site_list(base_url, hts, day):
+    """This function requests the site list from Hilltop. The day only forms
+    part of the cache key, so that the list is refreshed daily"""
+    return ws.site_list(base_url, hts)
 
 
 def get_site():
     """This function prompts the user to enter the WAP that they wish to generate plots for"""
+    # Fetch the site list once and keep it as a set for quick lookups
+    site_list = _cached_site_list(BASE_URL, HTS, dt.date.today().isoformat())
+    sites = frozenset(site_list.values.ravel().tolist())
     site = None
     while site is None:
         site_entry = input("Enter the WAP of interest: ")
-        site_list = ws.site_list('http://wateruse.ecan.govt.nz', 'WaterUse.hts')
-        if site_entry in site_list.values:
+        if site_entry in sites:
             site = site_entry
         else:
             print("The WAP you have entered is not in the WaterUse.hts file. Please try again.")
@@ -57,12 +82,17 @@ def get_date():
     return user_date
 
 
+@MEMORY.cache
+def _cached_measurement_list(base_url, hts, site, day):
+    """This function requests the measurement list for a site from Hilltop. The
+    day only forms part of the cache key, so that the list is refreshed daily"""
+    return ws.measurement_list(base_url, hts, site)
+
+
 def get_measurement_list(site):
     """Extracts the measurement types that are available in the Hilltop WaterUse.hts file
     for a given site"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    raw_list = ws.measurement_list(base_url, hts, site)
+    raw_list = _cached_measurement_list(BASE_URL, HTS, site, dt.date.today().isoformat())
     raw_list2 = raw_list.reset_index()    
     filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(['Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'])]
     return filtered_list
@@ -70,10 +100,7 @@ def get_measurement_list(site):
 
 def extract_water_use_data(site, measurement, from_d, to_d):
     """This function extracts water use data from Hilltop, and compiles it into a dataframe"""
-    # Set base parameters
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    tsdata = ws.get_data(base_url, hts, site, measurement, from_date=str(from_d), to_date=str(to_d))
+    tsdata = ws.get_data(BASE_URL, HTS, site, measurement, from_date=str(from_d), to_date=str(to_d))
     tsdata2 = tsdata.reset_index().drop(columns='Site')
     return tsdata2
 
@@ -84,101 +111,117 @@ def convert_water_use_data(dataframe):
     vol_data = dataframe.copy()
     # Add date variable
     vol_data['Date'] = vol_data['DateTime'].dt.date
-    # Convert water meter data to volume
-    vol_data.loc[vol_data['Measurement'] == 'Water Meter', 'Vol'] = vol_data.Value.diff()
-    # Leave other measurement types as they are already in the correct unit
-    vol_data.loc[vol_data['Measurement'] != 'Water Meter', 'Vol'] = vol_data.Value    
+    # Convert water meter data to volume and leave other measurement types as
+    # they are already in the correct unit
+    is_meter = (vol_data['Measurement'] == 'Water Meter').to_numpy()
+    vol_data['Vol'] = np.where(is_meter, vol_data['Value'].diff().to_numpy(), vol_data['Value'].to_numpy())
     return vol_data
 
 
 def process_hourly_data(dataframe):
     """This function calculates hourly totals, adds in any days that are missing data and gets the
     dataframe ready for plotting"""
-    # Add time variables
-    dataframe['Date'] = dataframe['DateTime'].dt.date
-    dataframe['Year'] = dataframe['DateTime'].dt.year
-    dataframe['Month'] = dataframe['DateTime'].dt.month 
-    dataframe['DayVal'] = dataframe['DateTime'].dt.day
-    dataframe['Hour'] = dataframe['DateTime'].dt.hour
+    # Truncate the timestamps to the hour in a single pass
+    hour_ts = dataframe['DateTime'].to_numpy().astype('datetime64[h]')
     # Group by hour
-    hourly_vol = dataframe.groupby(['Date','Month','DayVal','Hour'])['Vol'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'}).reset_index()
+    hourly_vol = dataframe.groupby(hour_ts)['Vol'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'})
+    # Derive the date and hour from the unique hours
+    hours = pd.DatetimeIndex(hourly_vol.index)
+    hourly_vol.insert(0, 'Date', hours.normalize())
+    hourly_vol.insert(1, 'Hour', hours.hour)
+    hourly_vol = hourly_vol.reset_index(drop=True)
     return hourly_vol
 
 
 def add_missing_dates(hourly_vol1, from_date, to_date):
     """This function identifies days that are missing data and adds them to the main dataframe"""
-    # Generate a full list of dates
-    alldates_timestamp = pd.date_range(from_date, to_date)
-    alldates_datetime = alldates_timestamp.to_pydatetime()
-    alldates = []
-    for item in alldates_datetime:
-        date = item.date()
-        alldates.append(date)
-    # Generate a list of dates that have data
-    dates_with_data = hourly_vol1['Date'].unique().tolist()
-    # Generate a list of dates that are missing data
-    missing_dates = list(set(alldates) - set(dates_with_data))
-    # Convert to dataframe
-    missing_df = pd.DataFrame(missing_dates, columns = ['Date'])
-    # Merge into dataset
-    hourly_vol2 = pd.merge(hourly_vol1, missing_df, on='Date', how='outer')
-    # Tidy up dataframe
-    hourly_vol2['Readings'].fillna(0, inplace=True)
-    hourly_vol2['Volume'].fillna(0, inplace=True)
-    hourly_vol2['Hour'].fillna(0, inplace=True)
-    hourly_vol2['Date'] = pd.to_datetime(hourly_vol2['Date'])
-    hourly_vol2['DayVal'] = hourly_vol2['Date'].dt.day
-    hourly_vol2['Month'] = hourly_vol2['Date'].dt.month
-    hourly_vol2['Year'] = hourly_vol2['Date'].dt.year
-    hourly_vol2['Hour'] = hourly_vol2['Hour'].astype(int)
+    # Generate a full index of dates and hours, already in date and hour order, up to but excluding the end date
+    alldates = pd.date_range(from_date, to_date)[:-1]
+    full_idx = pd.MultiIndex.from_product([alldates, range(24)], names=['Date','Hour'])
+    # Add any missing dates and hours to the dataset with zero readings
+    hourly_vol2 = hourly_vol1.set_index(['Date','Hour'])[['Readings','Volume']].reindex(full_idx, fill_value=0).reset_index()
+    # Tidy up dataframe, taking the date parts from the unique dates rather than every row
+    hourly_vol2['DayVal'] = np.repeat(alldates.day, 24)
+    hourly_vol2['Month'] = np.repeat(alldates.month, 24)
+    hourly_vol2['Year'] = np.repeat(alldates.year, 24)
     hourly_vol2['Readings'] = hourly_vol2['Readings'].astype(int)
     hourly_vol2['Volume'] = hourly_vol2['Volume'].astype(int)
     # Add in extra date labels needed for plotting
-    hourly_vol2['DayVal2'] = hourly_vol2['DayVal'].apply(lambda x: '{0:0>2}'.format(x))
-    hourly_vol2['Day'] = hourly_vol2['Year'].astype(str) + "/" + hourly_vol2['Month'].astype(str) + "/" + hourly_vol2['DayVal'].astype(str)    
-    # Sort by date and hour
-    hourly_vol2.sort_values(by=['Date','Hour'], inplace=True)
-    # Drop last row
-    hourly_vol2.drop(hourly_vol2.tail(1).index,inplace=True)
+    hourly_vol2['Day'] = np.repeat(alldates.strftime('%Y/%m/%d'), 24)
     return hourly_vol2
 
    
+def plot_hourly_grid(dataframe, column, title, pp, bar=False):
+    """This function plots an hourly variable on a grid with one panel per day
+    and saves the figure to the pdf file"""
+    # The data holds 24 hours for every day in date order, so reshape to one row per day
+    days = dataframe['Day'].unique()
+    hours = np.arange(24)
+    values = dataframe[column].to_numpy().reshape(len(days), 24)
+    grid_count = len(days)
+    # Pick one colour per day
+    if grid_count <= len(sns.color_palette()):
+        colors = sns.color_palette(n_colors=grid_count)
+    else:
+        colors = sns.color_palette('husl', grid_count)
+    ncols = min(grid_count, 7)
+    nrows = math.ceil(grid_count / 7)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(ncols * 1.5, nrows * 1.5),
+                             sharex=True, sharey=True, squeeze=False)
+    axes = axes.flatten()
+    # Draw each day in its own panel
+    for i, day in enumerate(days):
+        ax = axes[i]
+        if bar:
+            ax.bar(hours, values[i], color=colors[i])
+        else:
+            ax.plot(hours, values[i], color=colors[i])
+        ax.set_title('Day = {}'.format(day))
+        if i % ncols == 0:
+            ax.set_ylabel(column)
+        if i + ncols >= grid_count:
+            ax.set_xlabel('Hour')
+    # Hide any unused panels at the end of the grid
+    for ax in axes[grid_count:]:
+        ax.set_visible(False)
+    fig.tight_layout(w_pad=1)
+    fig.subplots_adjust(top=0.9)
+    fig.suptitle(title)
+    fig.savefig(pp, format='pdf')
+    plt.close(fig)
+
+
 def generate_hourly_plots(dataframe, site, measurement, from_date):
     """This function generates the hourly plots and outputs them to a pdf file"""
     # Open pdf
     filename = site.replace('/','-') + ' - {0} - 35 days from {1}'.format(measurement, from_date)
     pp = PdfPages(filename + '.pdf')
     # Create bar plot of meter readings
-    hourly_report_grid = sns.FacetGrid(dataframe, col="Day", hue="Day",
-                         col_wrap=7, height=1.5)  
-    hourly_report_grid.map(plt.bar, "Hour", "Readings")
-    hourly_report_grid.fig.tight_layout(w_pad=1)
-    plt.subplots_adjust(top=0.9)
-    hourly_report_grid.fig.suptitle('Meter readings received (hourly)')
-    hourly_report_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_hourly_grid(dataframe, 'Readings', 'Meter readings received (hourly)', pp, bar=True)
     # Create line plot of hourly volumes
-    hourly_vol_grid = sns.FacetGrid(dataframe, col="Day", hue="Day",
-                         col_wrap=7, height=1.5, dropna=False)
-    hourly_vol_grid.map(plt.plot, "Hour", "Volume")
-    hourly_vol_grid.fig.tight_layout(w_pad=1)
-    plt.subplots_adjust(top=0.9)
-    hourly_vol_grid.fig.suptitle('Volume extracted in m3 (hourly)')
-    hourly_vol_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_hourly_grid(dataframe, 'Volume', 'Volume extracted in m3 (hourly)', pp)
     # Create bar plot of hourly volumes
-    hourly_vol_grid = sns.FacetGrid(dataframe, col="Day", hue="Day",
-                         col_wrap=7, height=1.5, dropna=False)
-    hourly_vol_grid.map(plt.bar, "Hour", "Volume")
-    hourly_vol_grid.fig.tight_layout(w_pad=1)
-    plt.subplots_adjust(top=0.9)
-    hourly_vol_grid.fig.suptitle('Volume extracted in m3 (hourly)')
-    hourly_vol_grid.savefig(pp, format='pdf')
-    plt.close()    
+    plot_hourly_grid(dataframe, 'Volume', 'Volume extracted in m3 (hourly)', pp, bar=True)
     #Close pdf file
-    pp.close()    
+    pp.close()
+
+
+def prepare_measurement_data(site, measurement, from_date, to_date):
+    """This function extracts and processes the hourly data for one measurement
+    type, returning None if there is no data to plot"""
+    try:
+        # Extract water use data
+        wu_data = extract_water_use_data(site, measurement, from_date, to_date)
+        # Convert water use data to a common unit
+        vol_data = convert_water_use_data(wu_data)
+        # Process hourly data
+        hourly_vol = process_hourly_data(vol_data)
+        # Add any missing dates
+        return add_missing_dates(hourly_vol, from_date, to_date)
+    except ValueError:
+        return None
+
 
-    
 def main():
     """This function controls the execution of the main program"""
    # Get site
@@ -189,22 +232,18 @@ def main():
     end_date = start_date + dt.timedelta(days = 35)
     # Extract measurement list
     mslist = get_measurement_list(site) 
-    # Extraction and plotting
-    for index, row in mslist.iterrows():
-        measurement = row['Measurement']
-        try:
-            # Extract water use data
-            wu_data = extract_water_use_data(site, measurement, start_date, end_date)
-            # Convert water use data to a common unit
-            vol_data = convert_water_use_data(wu_data)
-            # Process hourly data
-            hourly_vol = process_hourly_data(vol_data)
-            # Add any missing dates
-            hourly_vol2 = add_missing_dates(hourly_vol, start_date, end_date)
-            # Create plots
-            print("Creating plots for {} data".format(measurement))
-            generate_hourly_plots(hourly_vol2, site, measurement, start_date)               
-        except ValueError:
+    # Extract the measurement types concurrently, as each is an independent request
+    measurements = mslist['Measurement'].tolist()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hourly_data = list(executor.map(prepare_measurement_data, repeat(site), measurements,
+                                        repeat(start_date), repeat(end_date)))
+    # Plotting stays on the main thread as matplotlib is not thread-safe
+    for measurement, hourly_vol2 in zip(measurements, hourly_data):
+        if hourly_vol2 is None:
             print("There is no {} data to plot".format(measurement))
+            continue
+        # Create plots
+        print("Creating plots for {} data".format(measurement))
+        generate_hourly_plots(hourly_vol2, site, measurement, start_date)
     print("Process completed")
 main()
\ No newline at end of file
@@ -14,15 +14,32 @@ Outputs of the program:
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas and datetime modules
+2. Have installed the pandas, numpy, numba, requests and datetime modules
 (NB: these come packaged with the Anaconda distribution of Python).
 """
 
 import pandas as pd
+import numpy as np
 import datetime as dt
 from hilltoppy import web_service as ws
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 import os.path
 
+# Measurement types that hold water use volumes
+_KEEP_MEAS = frozenset({'Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'})
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+
+# Reuse one keep-alive HTTP session for every Hilltop request
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+ws.requests.get = SESSION.get
+
 
 def get_filename():
     """Prompts the user to enter the name of the csv file containing a list
@@ -40,74 +57,100 @@ def get_filename():
 def read_csv(filename):
     """Reads the contents of a given csv file, that contains a list of WAP
     datasets"""
-    infile = open(filename)
-    lines = infile.readlines()
-    infile.close()
+    wap_list = pd.read_csv(filename, header=None, usecols=[0], dtype=str).iloc[:, 0]
+    # Strip whitespace and drop repeated WAPs so each is processed once
+    lines = wap_list.str.strip().drop_duplicates().tolist()
     return lines
 
 
 def get_measurement_list(site):
     """Extracts the measurement types that are available in the Hilltop WaterUse.hts file
     for a given site"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    raw_list = ws.measurement_list(base_url, hts, site)
+    raw_list = ws.measurement_list(BASE_URL, HTS, site)
     raw_list2 = raw_list.reset_index()    
-    filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(['Compliance Volume','Water Meter','Volume','Volume [Flow]','Volume [Average Flow]'])]
+    filtered_list = raw_list2.loc[raw_list2['Measurement'].isin(_KEEP_MEAS)]
     return filtered_list
 
 
 def process_measurement_list(dataframe):
     """This function prepares the measurement list so that it can be used to 
     extract water use data"""
-    processed_list = dataframe.copy()
-    # Add a default start date is start date is null
-    if processed_list['From'].isnull().values.any():
-        processed_list['From'] = processed_list['From'].fillna(pd.Timestamp('2000-01-01 00:00:00'))
-    # Order by start date
-    processed_list2 = processed_list.sort_values(by=['From'], ascending=True).reset_index(drop=True)
+    # Add a default start date if start date is null and order by start date
+    processed_list2 = (dataframe.assign(From=dataframe['From'].fillna(pd.Timestamp('2000-01-01 00:00:00')))
+                       .sort_values(by=['From'], ascending=True).reset_index(drop=True))
     # Add date attributes
     processed_list2['FromDate'] = processed_list2['From'].dt.date
     processed_list2['ToDate'] = processed_list2['To'].dt.date
     return processed_list2
 
 
+def fetch_water_use_data(site, measurement, from_d, to_d):
+    """This function extracts water use data from Hilltop for a single
+    measurement type and date range. None is returned if there is no data in
+    the date range, any other error is raised to the caller."""
+    try:
+        tsdata = ws.get_data(BASE_URL, HTS, site, measurement, from_date=str(from_d), to_date=str(to_d))
+    except ValueError:
+        return None
+    return tsdata.reset_index().drop(columns='Site')
+
+
+def _year_chunks(from_d, to_d):
+    """This function splits a date range into calendar year chunks. Every chunk
+    but the last runs to the final second of the year so no data is lost between
+    chunks"""
+    chunk_from = from_d
+    while chunk_from.year < to_d.year:
+        yield chunk_from, dt.datetime(chunk_from.year, 12, 31, 23, 59, 59)
+        chunk_from = dt.date(chunk_from.year + 1, 1, 1)
+    yield chunk_from, to_d
+
+
 def extract_and_combine_data(dataframe, site):
     """This function iterates through a measurement list, extracting water use
     data from Hilltop, and compiling it into a dataframe"""
-    # Set base parameters
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'    
-    # Create empty dataframe to append raw data into
-    raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     # Find the start date of the time series
     from_d = dataframe['FromDate'].iloc[0]
-    # Iterate through measurement list, extracting data and compiling
-    for index, row in dataframe.iterrows():
-        measurement = row['Measurement']
-        to_d = row['ToDate']
+    # Iterate through measurement list, working out the date range for each extraction
+    extractions = []
+    for row in dataframe[['Measurement','ToDate']].itertuples(index=False):
+        measurement, to_d = row.Measurement, row.ToDate
         if from_d <= to_d:
+            extractions.append((measurement, list(_year_chunks(from_d, to_d))))
+            # Adjust start date to prevent overlapping time series
+            from_d = to_d + dt.timedelta(days=1)
+    # Extract the data concurrently in yearly chunks, compiling it in chronological order
+    frames = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [(m, [executor.submit(fetch_water_use_data, site, m, f, t) for f, t in chunks])
+                   for m, chunks in extractions]
+        for measurement, chunk_futures in futures:
+            # Skip the whole measurement if any chunk fails, so no years are silently lost
             try:
-                tsdata = ws.get_data(base_url, hts, site, measurement, from_date=str(from_d), to_date=str(to_d))
-                tsdata2 = tsdata.reset_index().drop(columns='Site')
-                raw_data = pd.concat([raw_data, tsdata2], ignore_index=True)
-                # Adjust start date to prevent overlapping time series
-                from_d = to_d + dt.timedelta(days=1)
-            except:
-                from_d = to_d + dt.timedelta(days=1)
+                chunk_frames = [future.result() for future in chunk_futures]
+            except Exception:
+                print('Extraction failed for:', measurement)
+                continue
+            frames.extend(tsdata2 for tsdata2 in chunk_frames if tsdata2 is not None)
+    if frames:
+        raw_data = pd.concat(frames, ignore_index=True, copy=False)
+    else:
+        raw_data = pd.DataFrame(columns = ['Measurement','DateTime','Value'])
     return raw_data
 
 
 def convert_water_use_data(dataframe):
     """This function creates a common unit for all the water use data
-    (volume extracted in cubic metres)."""
-    vol_data = dataframe.copy()
+    (volume extracted in cubic metres). The dataframe is updated in place."""
+    vol_data = dataframe
+    # Store measurement types as an ordered category so comparisons use codes
+    vol_data['Measurement'] = vol_data['Measurement'].astype('category').cat.as_ordered()
     # Add date variable
-    vol_data['Date'] = vol_data['DateTime'].dt.date
-    # Convert water meter data to volume
-    vol_data.loc[vol_data['Measurement'] == 'Water Meter', 'Vol'] = vol_data.Value.diff()
-    # Leave other measurement types as they are already in the correct unit
-    vol_data.loc[vol_data['Measurement'] != 'Water Meter', 'Vol'] = vol_data.Value    
+    vol_data['Date'] = vol_data['DateTime'].dt.normalize()
+    # Convert water meter data to volume and leave other measurement types as
+    # they are already in the correct unit
+    is_meter = (vol_data['Measurement'] == 'Water Meter').to_numpy()
+    vol_data['Vol'] = np.where(is_meter, vol_data['Value'].diff().to_numpy(), vol_data['Value'].to_numpy())
     return vol_data
 
 
@@ -120,35 +163,54 @@ def summarise_negative_values(dataframe):
 
 
 def remove_negative_values(dataframe):
-    """This function removes negative values from the water use dataset"""
-    vol_data2 = dataframe[dataframe['Vol'] >= 0]
-    return vol_data2
+    """This function removes negative values from the water use dataset. The
+    rows are dropped in place."""
+    dataframe.drop(dataframe.index[~(dataframe['Vol'] >= 0)], inplace=True)
+    return dataframe
+
+
+@njit(cache=True)
+def _welford_nonzero(vol):
+    """This function calculates the count, mean and standard deviation of the
+    volumes greater than zero in a single pass (Welford's algorithm)"""
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(vol.shape[0]):
+        x = vol[i]
+        if x > 0:
+            n += 1
+            delta = x - mean
+            mean += delta / n
+            m2 += delta * (x - mean)
+    if n == 0:
+        return n, np.nan, np.nan
+    if n < 2:
+        return n, mean, np.nan
+    return n, mean, (m2 / (n - 1)) ** 0.5
 
 
 def calculate_spike_parameters(dataframe):
     """This function calculates measures of central tendency that will be used
     to detect spikes"""
-    # Filter out rows where extraction is greater than zero
-    nonzero_vol = dataframe[dataframe.Vol > 0]
-    # Calculate mean and standard deviation
-    mean = nonzero_vol['Vol'].mean()
-    sd = nonzero_vol['Vol'].std()
+    # Calculate mean and standard deviation of the volumes greater than zero
+    _, mean, sd = _welford_nonzero(dataframe['Vol'].to_numpy(dtype=float))
     return mean, sd
 
 
 def detect_spikes(dataframe, mean, sd):
     """This function identifies spikes (extreme values of water extraction) and
-    adds flags to the water use dataset"""
-    vol_stats = dataframe.copy()
-    # Add spike columns to dataframe
-    vol_stats['sd5'] = 0  
-    vol_stats['sd10'] = 0
-    vol_stats['sd20'] = 0
-    # Add flags if a single value is classified as a spike
-    if sd >=1 and len(vol_stats) > 100:
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 5, 'sd5'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 10, 'sd10'] = 1
-        vol_stats.loc[vol_stats['Vol'] > mean + sd * 20, 'sd20'] = 1 
+    adds flags to the water use dataset in place"""
+    vol_stats = dataframe
+    # Return zero flags straight away if no value can be classified as a spike
+    if not (sd >=1 and len(vol_stats) > 100):
+        vol_stats['sd5'] = vol_stats['sd10'] = vol_stats['sd20'] = np.int8(0)
+        return vol_stats
+    # Express each volume as a number of standard deviations above the mean
+    z = (vol_stats['Vol'].to_numpy() - mean) / sd
+    vol_stats['sd5'] = (z > 5).astype(np.int8)
+    vol_stats['sd10'] = (z > 10).astype(np.int8)
+    vol_stats['sd20'] = (z > 20).astype(np.int8)
     return vol_stats
 
 
@@ -156,48 +218,67 @@ def generate_summary_stats(dataframe, site, data_exists, meas_types, neg_count,
     """This function generates daily water use statistics"""
     # meas_types
     meas_used = dataframe['Measurement'].nunique()
-    start_date = dataframe['Date'].min()  
-    end_date = dataframe['Date'].max()
+    start_date = dataframe['Date'].min().date()
+    end_date = dataframe['Date'].max().date()
     total_days = (end_date - start_date).days + 1
     days_with_data = dataframe['Date'].nunique()
-    total_reports = dataframe['Vol'].count()
+    # Work on the raw volume array to avoid repeated passes through pandas
+    vol = dataframe['Vol'].to_numpy(dtype=float)
+    total_reports = np.count_nonzero(~np.isnan(vol))
     # neg_count
-    min_extraction = dataframe[dataframe['Vol']>0].min()['Vol']
+    nonzero_vol = vol[vol > 0]
+    min_extraction = nonzero_vol.min() if nonzero_vol.size else np.nan
     # mean
-    max_extraction = dataframe['Vol'].max()
-    sd5 = dataframe['sd5'].sum()
-    sd10 = dataframe['sd10'].sum()
-    sd20 = dataframe['sd20'].sum()
-    # Write summary stats to dataframe
+    max_extraction = np.nanmax(vol) if total_reports else np.nan
+    sd5, sd10, sd20 = dataframe[['sd5','sd10','sd20']].sum().to_numpy()
+    # Write summary stats to a results row
     stats = {'Site':site, 'InHilltop':data_exists, 'MeasTypes':meas_types, 'MeasUsed':meas_used, 
              'StartDate':start_date, 'EndDate':end_date, 'TotalDays':total_days,
              'DaysWithData':days_with_data, 'TotalReports':total_reports,
              'MinExtraction': round(min_extraction, 3), 'MeanExtraction': round(mean, 1),
              'MaxExtraction':round(max_extraction, 1), 'NegativeValues':neg_count,
              'Spikes > 5sd':sd5, 'Spikes > 10sd':sd10, 'Spikes > 20sd':sd20}
-    stats_df = pd.DataFrame(data=stats, index=['Default'])
-    return stats_df
+    return stats
 
 
 def record_missing_site(site, data_exists):
-    """This function adds a row to the results dataframe when a site has no Hilltop data"""
-    # Write summary information to dataframe
+    """This function creates a results row when a site has no Hilltop data"""
+    # Write summary information to a results row
     stats = {'Site':site, 'InHilltop':data_exists, 'MeasTypes':'', 'MeasUsed':'',
              'StartDate':'', 'EndDate':'', 'TotalDays':'',
              'DaysWithData':'', 'TotalReports':'', 'MinExtraction':'',
              'MeanExtraction':'', 'MaxExtraction':'', 'NegativeValues':'',
              'Spikes > 5sd':'', 'Spikes > 10sd':'', 'Spikes > 20sd':''}    
-    missing_df = pd.DataFrame(data=stats, index=['Default'])
-    return missing_df    
+    return stats
+
+
+def write_sheet(writer, dataframe, sheet_name):
+    """This function writes a dataframe and its index to a new worksheet one row
+    at a time, as required by xlsxwriter's constant_memory mode"""
+    worksheet = writer.book.add_worksheet(sheet_name)
+    header_format = writer.book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    # Show the time of day in datetime columns, plain dates use the workbook default
+    datetime_format = writer.book.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    formats = [datetime_format if pd.api.types.is_datetime64_any_dtype(dtype) else None
+               for dtype in dataframe.dtypes]
+    # Write column headings
+    worksheet.write(0, 0, dataframe.index.name, header_format)
+    worksheet.write_row(0, 1, list(dataframe.columns), header_format)
+    # Write the index and values row by row
+    for row_num, row in enumerate(dataframe.itertuples(), start=1):
+        worksheet.write(row_num, 0, row[0], header_format)
+        for col_num, (value, cell_format) in enumerate(zip(row[1:], formats), start=1):
+            worksheet.write(row_num, col_num, None if pd.isna(value) else value, cell_format)
+    return worksheet
 
 
 def export_summary_stats(dataframe, csv_input):
     """This function exports water use statistics to Excel"""
-    # Create Excel file
-    writer = pd.ExcelWriter('QA for Sites in {} - Combined Series.xlsx'.format(csv_input), engine='xlsxwriter')
+    # Create Excel file, streaming rows to disk as they are written
+    writer = pd.ExcelWriter('QA for Sites in {} - Combined Series.xlsx'.format(csv_input), engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'}})
     # Export measurement list
-    dataframe.to_excel(writer, sheet_name='QualityAssessment')
-    worksheet = writer.sheets['QualityAssessment']
+    worksheet = write_sheet(writer, dataframe, 'QualityAssessment')
     worksheet.set_column('A:A', 3)
     worksheet.set_column('B:B', 15)
     worksheet.set_column('C:C', 8)
@@ -215,15 +296,15 @@ def main():
     csv_input = get_filename()
     site_list = read_csv(csv_input)
     
-    # Create empty dataframe to append results into
-    master = pd.DataFrame(columns = ['Site','InHilltop','MeasTypes','MeasUsed','StartDate','EndDate',
-                                     'TotalDays','DaysWithData','TotalReports','MinExtraction',
-                                     'MeanExtraction','MaxExtraction','NegativeValues','Spikes > 5sd',
-                                     'Spikes > 10sd','Spikes > 20sd'])     
+    # Set the results columns and create a list to collect results into
+    columns = ['Site','InHilltop','MeasTypes','MeasUsed','StartDate','EndDate',
+               'TotalDays','DaysWithData','TotalReports','MinExtraction',
+               'MeanExtraction','MaxExtraction','NegativeValues','Spikes > 5sd',
+               'Spikes > 10sd','Spikes > 20sd']
+    master_rows = []
        
     # Iterate through site list
-    for wap in site_list:
-        site = wap.rstrip("\n")
+    for site in site_list:
         print("Processing {}".format(site))
         
         try:
@@ -253,14 +334,16 @@ def main():
             # Summarise water use statistics
             summary_stats = generate_summary_stats(vol_stats, site, data_exists, meas_types, neg_count, mean)
             # Append into results dataframe
-            master = pd.concat([master, summary_stats], ignore_index=True)
+            master_rows.append(summary_stats)
         
         elif data_exists == 'N':
             # Record missing site
             missing_info = record_missing_site(site, data_exists)
             # Append into results dataframe
-            master = pd.concat([master, missing_info], ignore_index=True) 
+            master_rows.append(missing_info)
         
+    # Combine the results into one dataframe
+    master = pd.DataFrame(master_rows, columns=columns)
     # Export water use statistics to Excel
     export_summary_stats(master, csv_input)
     print("")
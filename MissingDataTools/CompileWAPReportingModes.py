@@ -11,7 +11,7 @@ Notes:
 1. This program only needs to be run intermittently (perhaps every 2 months) as
 the reporting mode of most WAPs will be fairly stable.
 2. The program takes a considerable time to run. For this reason you may like to
-restrict it to a subset of WAPs (perhaps 500 at a time). You can use lines 38-42
+restrict it to a subset of WAPs (perhaps 500 at a time). You can use lines 72-76
 of the program to achieve this. If you adopt this approach, you will need to 
 compile the results from each subset into a combined csv file.
 
@@ -22,19 +22,53 @@ Outputs of the program:
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas and datetime modules (NB: these come packaged with
+2. Have installed the pandas, numpy, numba, requests, datetime and joblib modules (NB: these come packaged with
 the Anaconda distribution of Python)
 """
 
 
 from hilltoppy import web_service as ws
 import pandas as pd
+import numpy as np
 import datetime as dt
+import csv
+import logging
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from joblib import Memory
+from numba import njit
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+MEASUREMENT = 'Compliance Volume'
+
+# Reuse one keep-alive HTTP session for every Hilltop request
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+ws.requests.get = SESSION.get
+
+# Per-site progress is logged at debug level; only the final summary shows by default
+LOGGER = logging.getLogger(__name__)
+
+# Cache the Hilltop site list on disk so that repeat runs on the same day
+# skip the network
+MEMORY = Memory('.hilltop_cache', verbose=0)
+
+
+@MEMORY.cache
+def _cached_site_list(base_url, hts, day):
+    """Requests the site list from Hilltop. The day only forms part of the
+    cache key, so that the list is refreshed daily"""
+    return ws.site_list(base_url, hts)
 
 
 def get_site_list(base_url, hts):
     """Creates a dataframe of sites from the WaterUse.hts file"""
-    all_sites = ws.site_list(base_url, hts)
+    all_sites = _cached_site_list(base_url, hts, dt.date.today().isoformat())
     ################################
     # Restrict to a subset of sites
     sites = all_sites[3400:4000] 
@@ -46,222 +80,105 @@ def get_site_list(base_url, hts):
 def get_volume_data(base_url, hts, site, measurement, from_date, to_date):
     """Extracts compliance volume data from Hilltop for a given date range, and sums the reading counts for each day"""
     tsdata = ws.get_data(base_url, hts, site, measurement, from_date, to_date)
-    dfdata = tsdata.reset_index().drop(columns='Site').drop(columns='Measurement')
-    dfdata['Date'] = dfdata['DateTime'].dt.date
-    daily_counts = dfdata.groupby(['Date'])['Value'].agg(['count']).rename(columns={'count':'Readings'})
     idx = pd.date_range(from_date, to_date)
-    daily_counts2 = daily_counts.reindex(idx, fill_value=0)
-    return daily_counts2
+    # Count the readings on each day from their day offset to the start date
+    days = tsdata.index.get_level_values('DateTime').values.astype('datetime64[D]')
+    day_idx = (days - np.datetime64(from_date, 'D')).astype(np.int64)
+    in_range = (day_idx >= 0) & (day_idx < len(idx)) & tsdata['Value'].notna().values
+    # Daily counts are small, so int32 halves the memory the mode calculations read
+    counts = np.bincount(day_idx[in_range], minlength=len(idx)).astype(np.int32, copy=False)
+    daily_counts = pd.DataFrame({'Readings': counts}, index=idx)
+    return daily_counts
     
     
+@njit(cache=True)
+def _mode_and_freq(readings):
+    """Tallies the daily counts and returns the most common count, taking the
+    lowest of any ties, with the share of days on which it occurs"""
+    tally = np.zeros(readings.max() + 1, np.int64)
+    for count in readings:
+        tally[count] += 1
+    mode = 0
+    for count in range(1, tally.size):
+        if tally[count] > tally[mode]:
+            mode = count
+    return mode, tally[mode] / readings.size
+
+
+def calculate_mode(daily_counts, from_date, to_date):
+    """Calculates the reporting mode, and the share of days on which it occurs,
+    over one window of the daily reading counts"""
+    readings = daily_counts.loc[str(from_date):str(to_date), 'Readings'].values
+    mode, mode_freq = _mode_and_freq(readings)
+    return int(mode), round(float(mode_freq), 2)
+
+
+def compute_mode(site, number, today):
+    """Calculates the reporting mode of a site over the last year. If the mode
+    is zero it is recalculated over each of the last four quarters in turn. A
+    single request for the last year of data covers all five calculations.
+    Returns a record of the mode, or the reason if the mode cannot be calculated"""
+    year1 = today - dt.timedelta(days = 365)
+    LOGGER.debug("Retrieving annual data for Site %s - %s", number, site)
+    try:
+        annual_data = get_volume_data(BASE_URL, HTS, site, MEASUREMENT, str(year1), str(today))
+    except ValueError:
+        LOGGER.debug("No data in the last year for %s", site)
+        return 'No data'
+    except KeyError:
+        LOGGER.debug("Key error for annual calculation for %s", site)
+        return 'Key error'
+    mode, mode_freq = calculate_mode(annual_data, year1, today)
+    LOGGER.debug("Annual calculation successful for %s - Mode equals %s", site, mode)
+    record = {'Mode': mode, 'ModeFreq': mode_freq, 'Method': 'Annual'}
+    # Recalculate over each quarter in turn, working back from today, while the mode equals 0
+    qtr_end = today
+    for quarter in range(1, 5):
+        if record['Mode'] != 0:
+            break
+        qtr_start = qtr_end - dt.timedelta(days = 91)
+        qtr_mode = calculate_mode(annual_data, qtr_start, qtr_end)[0]
+        if qtr_mode > 0:
+            LOGGER.debug("Quarter %s calculation successful for %s - Mode equals %s", quarter, site, qtr_mode)
+            record = {'Mode': qtr_mode, 'ModeFreq': '', 'Method': 'Qtr{}'.format(quarter)}
+        else:
+            LOGGER.debug("Quarter %s mode still equals 0 for %s", quarter, site)
+        qtr_end = qtr_start
+    return record
+
+
+def write_modes(filename, results):
+    """Writes the reporting mode of each site to a csv file, quoting any site
+    names that contain a comma"""
+    with open(filename, 'w', newline='', buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['Site', 'Mode', 'ModeFreq', 'Method'])
+        writer.writerows((site, record['Mode'], record['ModeFreq'], record['Method'])
+                         for site, record in results.items())
+
+
 def main():
     """This function controls the execution of the main program"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    measurement = 'Compliance Volume'
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
     # Generate site list
-    site_list = get_site_list(base_url, hts)
+    site_list = get_site_list(BASE_URL, HTS)
     # Get today's date
     today = dt.date.today()
-    
-    ## Annual calculations
-    # Create first output file
-    outfile = open("WAPMode_Round1.csv", "w")
-    outfile.write("Site,Mode,ModeFreq,Method\n")
-    # Generate dates
-    year1 = today - dt.timedelta(days = 365)    
-    # Iterate through site list
-    i = 1
-    for index, row in site_list.iterrows():
-        site = row["SiteName"]
-        if ',' not in site:
-            print("Retrieving annual data for Site {0} - {1}".format(i, site))
-            try:
-                annual_data = get_volume_data(base_url, hts, site, measurement, str(year1), str(today))
-                mode = annual_data['Readings'].mode()[0]
-                mode_freq = round(annual_data[annual_data.Readings == mode].shape[0] / len(annual_data),2)
-                print("Annual calculation successful - Mode equals {}".format(mode))
-                result = "{0},{1},{2},Annual\n".format(site,mode,mode_freq)
-                outfile.write(result)
-                i += 1
-            except ValueError:
-                print("No data in the last year")
-                i += 1
-            except KeyError:
-                print("Key error for annual calculation")
-                i += 1           
-        elif ',' in site:
-            print("Skipping process for Site {0} - {1}".format(i, site))
-            i += 1
-    # Close output file
-    outfile.close()    
-    
-    ## First quarter calculations
-    # Read output file from first round
-    wap_modes = pd.read_csv('WAPMode_Round1.csv')
-    # Create second output file
-    outfile = open("WAPMode_Round2.csv", "w")
-    outfile.write("Site,Mode,ModeFreq,Method\n")
-    # Generate dates
-    qtr1_start = today - dt.timedelta(days = 91) 
-    # Iterate through file, recalculating if mode = 0
-    for index, row in wap_modes.iterrows(): 
-        site = row["Site"]
-        mode = row["Mode"]
-        mode_freq = row['ModeFreq']
-        method = row['Method']
-        if mode != 0:
-            result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-            outfile.write(result)
-        elif mode == 0:
-            try:
-                print("Retrieving 1st quarter data for {0}".format(site))
-                qtr1_data = get_volume_data(base_url, hts, site, measurement, str(qtr1_start), str(today))
-                qtr1_mode = qtr1_data['Readings'].mode()[0]
-                # Output calculations if mode > 0
-                if qtr1_mode > 0:
-                    print("First quarter calculation successful - Mode equals {}".format(qtr1_mode))
-                    result = "{0},{1},,Qtr1\n".format(site,qtr1_mode)
-                    outfile.write(result)
-                elif qtr1_mode == 0:
-                    print("Mode still equals {}".format(mode))
-                    result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                    outfile.write(result)
-            except ValueError:
-                print("No data for Quarter 1")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                
-            except KeyError:
-                print("Key error for Quarter 1")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                           
-    # Close output file
-    outfile.close()
-
-    ## Second quarter calculations
-    # Read output file from first round
-    wap_modes = pd.read_csv('WAPMode_Round2.csv')
-    # Create second output file
-    outfile = open("WAPMode_Round3.csv", "w")
-    outfile.write("Site,Mode,ModeFreq,Method\n")
-    # Generate dates
-    qtr2_start = qtr1_start - dt.timedelta(days = 91) 
-    # Iterate through file, recalculating if mode = 0
-    for index, row in wap_modes.iterrows(): 
-        site = row["Site"]
-        mode = row["Mode"]
-        mode_freq = row['ModeFreq']
-        method = row['Method']
-        if mode != 0:
-            result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-            outfile.write(result)
-        elif mode == 0:
-            try:
-                print("Retrieving 2nd quarter data for {0}".format(site))
-                qtr2_data = get_volume_data(base_url, hts, site, measurement, str(qtr2_start), str(qtr1_start))
-                qtr2_mode = qtr2_data['Readings'].mode()[0]
-                # Output calculations if mode > 0
-                if qtr2_mode > 0:
-                    print("Second quarter calculation successful - Mode equals {}".format(qtr2_mode))
-                    result = "{0},{1},,Qtr2\n".format(site,qtr2_mode)
-                    outfile.write(result)
-                elif qtr2_mode == 0:
-                    print("Mode still equals {}".format(mode))
-                    result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                    outfile.write(result)
-            except ValueError:
-                print("No data for Quarter 2")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                
-            except KeyError:
-                print("Key error for Quarter 2")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                           
-    # Close output file
-    outfile.close()    
-
-    ## Third quarter calculations
-    # Read output file from first round
-    wap_modes = pd.read_csv('WAPMode_Round3.csv')
-    # Create second output file
-    outfile = open("WAPMode_Round4.csv", "w")
-    outfile.write("Site,Mode,ModeFreq,Method\n")
-    # Generate dates
-    qtr3_start = qtr2_start - dt.timedelta(days = 91) 
-    # Iterate through file, recalculating if mode = 0
-    for index, row in wap_modes.iterrows(): 
-        site = row["Site"]
-        mode = row["Mode"]
-        mode_freq = row['ModeFreq']
-        method = row['Method']
-        if mode != 0:
-            result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-            outfile.write(result)
-        elif mode == 0:
-            try:
-                print("Retrieving 3rd quarter data for {0}".format(site))
-                qtr3_data = get_volume_data(base_url, hts, site, measurement, str(qtr3_start), str(qtr2_start))
-                qtr3_mode = qtr3_data['Readings'].mode()[0]
-                # Output calculations if mode > 0
-                if qtr3_mode > 0:
-                    print("Third quarter calculation successful - Mode equals {}".format(qtr3_mode))
-                    result = "{0},{1},,Qtr3\n".format(site,qtr3_mode)
-                    outfile.write(result)
-                elif qtr3_mode == 0:
-                    print("Mode still equals {}".format(mode))
-                    result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                    outfile.write(result)
-            except ValueError:
-                print("No data for Quarter 3")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                
-            except KeyError:
-                print("Key error for Quarter 3")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                           
-    # Close output file
-    outfile.close()
-    
-    ## Fourth quarter calculations
-    # Read output file from first round
-    wap_modes = pd.read_csv('WAPMode_Round4.csv')
-    # Create second output file
-    outfile = open("WAPReportingMode.csv", "w")
-    outfile.write("Site,Mode,ModeFreq,Method\n")
-    # Generate dates
-    qtr4_start = qtr3_start - dt.timedelta(days = 91) 
-    # Iterate through file, recalculating if mode = 0
-    for index, row in wap_modes.iterrows(): 
-        site = row["Site"]
-        mode = row["Mode"]
-        mode_freq = row['ModeFreq']
-        method = row['Method']
-        if mode != 0:
-            result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-            outfile.write(result)
-        elif mode == 0:
-            try:
-                print("Retrieving 4th quarter data for {0}".format(site))
-                qtr4_data = get_volume_data(base_url, hts, site, measurement, str(qtr4_start), str(qtr3_start))
-                qtr4_mode = qtr4_data['Readings'].mode()[0]
-                # Output calculations if mode > 0
-                if qtr4_mode > 0:
-                    print("Fourth quarter calculation successful - Mode equals {}".format(qtr4_mode))
-                    result = "{0},{1},,Qtr4\n".format(site,qtr4_mode)
-                    outfile.write(result)
-                elif qtr4_mode == 0:
-                    print("Mode still equals {}".format(mode))
-                    result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                    outfile.write(result)
-            except ValueError:
-                print("No data for Quarter 4")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                
-            except KeyError:
-                print("Key error for Quarter 4")
-                result = "{0},{1},{2},{3}\n".format(site,mode,mode_freq,method)
-                outfile.write(result)                           
-    # Close output file
-    outfile.close()     
+    sites = site_list['SiteName'].tolist()
+    numbers = range(1, len(sites) + 1)
+    # Calculate the modes for all sites concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = executor.map(compute_mode, sites, numbers, repeat(today))
+        # Keep the results in memory, keyed by site, and count the sites without a mode
+        modes = {}
+        failures = Counter()
+        for site, result in zip(sites, results):
+            if isinstance(result, dict):
+                modes[site] = result
+            else:
+                failures[result] += 1
+    # Create output file
+    write_modes("WAPReportingMode.csv", modes)
+    LOGGER.warning("Modes calculated for %s of %s sites. No mode for: %s", len(modes), len(sites), dict(failures))
 
 main()
\ No newline at end of file
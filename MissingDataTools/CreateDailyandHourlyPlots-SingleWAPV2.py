@@ -13,7 +13,7 @@ Inputs to the program:
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas, numpy, seaborn, matplotlib and datetime modules
+2. Have installed the pandas, numpy, seaborn, matplotlib, datetime and joblib modules
 (NB: these come packaged with the Anaconda distribution of Python).
 """
 
@@ -21,18 +21,41 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import datetime as dt
+import math
+import matplotlib
+# Render plots without a display, as they are only written to pdf
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from concurrent.futures import ThreadPoolExecutor
 from hilltoppy import web_service as ws
+from joblib import Memory
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+
+# Cache Hilltop site lists on disk so that repeat runs on the same day
+# skip the network
+MEMORY = Memory('.hilltop_cache', verbose=0)
+
+
+@MEMORY.cache
+def _cached_site_list(base_url, hts, day):
+    """This function requests the site list from Hilltop. The day only forms
+    part of the cache key, so that the list is refreshed daily"""
+    return ws.site_list(base_url, hts)
 
 
 def get_site():
     """This function prompts the user to enter the WAP that they wish to generate plots for"""
+    # Fetch the site list once and keep it as a set for quick lookups
+    site_list = _cached_site_list(BASE_URL, HTS, dt.date.today().isoformat())
+    sites = frozenset(site_list.values.ravel().tolist())
     site = None
     while site is None:
         site_entry = input("Enter the WAP of interest: ")
-        site_list = ws.site_list('http://wateruse.ecan.govt.nz', 'WaterUse.hts')
-        if site_entry in site_list.values:
+        if site_entry in sites:
             site = site_entry
         else:
             print("Not a valid WAP. Please try again.")
@@ -41,10 +64,8 @@ def get_site():
 
 def get_volume_data(site, from_date, to_date):
     """Extracts compliance volume data from Hilltop for a given date range, and sums the reading counts for each day"""
-    base_url = 'http://wateruse.ecan.govt.nz'
-    hts = 'WaterUse.hts'
-    measurement = 'Compliance Volume'    
-    tsdata = ws.get_data(base_url, hts, site, measurement, from_date, to_date)
+    measurement = 'Compliance Volume'
+    tsdata = ws.get_data(BASE_URL, HTS, site, measurement, from_date, to_date)
     vol_data = tsdata.reset_index().drop(columns='Site').drop(columns='Measurement')
     return vol_data
 
@@ -52,15 +73,13 @@ def get_volume_data(site, from_date, to_date):
 def process_daily_data(dataframe, from_date, to_date):
     """This function calculates daily totals, adds in any days that are missing data and gets the
     dataframe ready for plotting"""
-    dataframe['Date'] = dataframe['DateTime'].dt.date
+    # Keep the day as datetime64 so the counts align directly with the date range
+    dataframe['Date'] = dataframe['DateTime'].dt.floor('D')
     daily_counts = dataframe.groupby(['Date'])['Value'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'})
     idx = pd.date_range(from_date, to_date)
     daily_counts2 = daily_counts.reindex(idx)
     daily_counts2 = daily_counts2.reset_index().rename(columns={'index':'Date'})
-    daily_counts2['Year'] = daily_counts2['Date'].dt.year
-    daily_counts2['MonthVal'] = daily_counts2['Date'].dt.month 
-    daily_counts2['MonthVal2'] = daily_counts2['MonthVal'].apply(lambda x: '{0:0>2}'.format(x))
-    daily_counts2['Month'] = daily_counts2['Year'].astype(str) + "-" + daily_counts2['MonthVal2'].astype(str)
+    daily_counts2['Month'] = daily_counts2['Date'].dt.strftime('%Y-%m')
     daily_counts2['Day'] = daily_counts2['Date'].dt.day    
     return daily_counts2
 
@@ -95,81 +114,86 @@ def generate_daily_plots(site, dataframe):
 def process_hourly_data(vol_data2, from_date, to_date):
     """This function calculates hourly totals, adds in any days that are missing data and gets the
     dataframe ready for plotting"""
-    # Add time variables
-    vol_data2['Date'] = vol_data2['DateTime'].dt.date
-    vol_data2['Year'] = vol_data2['DateTime'].dt.year
-    vol_data2['Month'] = vol_data2['DateTime'].dt.month 
-    vol_data2['DayVal'] = vol_data2['DateTime'].dt.day
-    vol_data2['Hour'] = vol_data2['DateTime'].dt.hour
+    # Truncate the timestamps to the hour in a single pass
+    hour_ts = vol_data2['DateTime'].to_numpy().astype('datetime64[h]')
     # Group by hour
-    hourly_vol = vol_data2.groupby(['Date','Month','DayVal','Hour'])['Value'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'}).reset_index()
+    hourly_vol = vol_data2.groupby(hour_ts)['Value'].agg(['count', 'sum']).rename(columns={'count':'Readings', 'sum':'Volume'})
+    # Derive the date and hour from the unique hours
+    hours = pd.DatetimeIndex(hourly_vol.index)
+    hourly_vol.insert(0, 'Date', hours.normalize())
+    hourly_vol.insert(1, 'Hour', hours.hour)
+    hourly_vol = hourly_vol.reset_index(drop=True)
     return hourly_vol
 
 
 def add_missing_dates(hourly_vol1, from_date, to_date):
     """This function identifies days that are missing data and adds them to the main dataframe"""
-    # Generate a full list of dates
-    alldates_timestamp = pd.date_range(from_date, to_date)
-    alldates_datetime = alldates_timestamp.to_pydatetime()
-    alldates = []
-    for item in alldates_datetime:
-        date = item.date()
-        alldates.append(date)
-    # Generate a list of dates that have data
-    dates_with_data = hourly_vol1['Date'].unique().tolist()
-    # Generate a list of dates that are missing data
-    missing_dates = list(set(alldates) - set(dates_with_data))
-    # Convert to dataframe
-    missing_df = pd.DataFrame(missing_dates, columns = ['Date'])
-    # Merge into dataset
-    hourly_vol2 = pd.merge(hourly_vol1, missing_df, on='Date', how='outer')
-    # Tidy up dataframe
-    hourly_vol2['Readings'].fillna(0, inplace=True)
-    hourly_vol2['Volume'].fillna(0, inplace=True)
-    hourly_vol2['Hour'].fillna(0, inplace=True)
-    hourly_vol2['Date'] = pd.to_datetime(hourly_vol2['Date'])
-    hourly_vol2['DayVal'] = hourly_vol2['Date'].dt.day
-    hourly_vol2['Month'] = hourly_vol2['Date'].dt.month
-    hourly_vol2['Hour'] = hourly_vol2['Hour'].astype(int)
+    # Generate a full index of dates and hours, already in date and hour order
+    alldates = pd.date_range(from_date, to_date)
+    full_idx = pd.MultiIndex.from_product([alldates, range(24)], names=['Date','Hour'])
+    # Add any missing dates and hours to the dataset with zero readings
+    hourly_vol2 = hourly_vol1.set_index(['Date','Hour'])[['Readings','Volume']].reindex(full_idx, fill_value=0).reset_index()
+    # Tidy up dataframe, taking the date parts from the unique dates rather than every row
+    hourly_vol2['DayVal'] = np.repeat(alldates.day, 24)
+    hourly_vol2['Month'] = np.repeat(alldates.month, 24)
     hourly_vol2['Readings'] = hourly_vol2['Readings'].astype(int)
     hourly_vol2['Volume'] = hourly_vol2['Volume'].astype(int)
     # Add in extra date labels needed for plotting
-    hourly_vol2['DayVal2'] = hourly_vol2['DayVal'].apply(lambda x: '{0:0>2}'.format(x))
-    hourly_vol2['Day'] = hourly_vol2['Month'].astype(str) + "/" + hourly_vol2['DayVal'].astype(str)    
-    # Sort by date and hour
-    hourly_vol2.sort_values(by=['Date','Hour'], inplace=True)
+    hourly_vol2['Day'] = np.repeat(alldates.strftime('%m/%d'), 24)
     return hourly_vol2
 
     
+def plot_hourly_grid(dataframe, column, title, pp, bar=False):
+    """This function plots an hourly variable on a grid with one panel per day
+    and saves the figure to the pdf file"""
+    # The data holds 24 hours for every day in date order, so reshape to one row per day
+    days = dataframe['Day'].unique()
+    hours = np.arange(24)
+    values = dataframe[column].to_numpy().reshape(len(days), 24)
+    grid_count = len(days)
+    # Pick one colour per day
+    if grid_count <= len(sns.color_palette()):
+        colors = sns.color_palette(n_colors=grid_count)
+    else:
+        colors = sns.color_palette('husl', grid_count)
+    ncols = min(grid_count, 7)
+    nrows = math.ceil(grid_count / 7)
+    fig, axes = plt.subplots(nrows, ncols, figsize=(ncols * 1.5, nrows * 1.5),
+                             sharex=True, sharey=True, squeeze=False)
+    axes = axes.flatten()
+    # Draw each day in its own panel
+    for i, day in enumerate(days):
+        ax = axes[i]
+        if bar:
+            ax.bar(hours, values[i], color=colors[i])
+        else:
+            ax.plot(hours, values[i], color=colors[i])
+        ax.set_title('Day = {}'.format(day))
+        if i % ncols == 0:
+            ax.set_ylabel(column)
+        if i + ncols >= grid_count:
+            ax.set_xlabel('Hour')
+    # Hide any unused panels at the end of the grid
+    for ax in axes[grid_count:]:
+        ax.set_visible(False)
+    fig.tight_layout(w_pad=1)
+    fig.subplots_adjust(top=0.9)
+    fig.suptitle(title)
+    fig.savefig(pp, format='pdf')
+    plt.close(fig)
+
+
 def generate_hourly_plots(site, dataframe):
     """This function generates the hourly plots and outputs them to a pdf file"""
     # Open pdf
     filename = site.replace('/','-') + ' - Hourly Plots'
     pp = PdfPages(filename + '.pdf')
     # Create line plot of hourly volumes
-    hourly_vol_grid = sns.FacetGrid(dataframe, col="Day", hue="Day",
-                         col_wrap=7, height=1.5, dropna=False)
-    hourly_vol_grid.map(plt.plot, "Hour", "Volume")
-    hourly_vol_grid.fig.tight_layout(w_pad=1)
-    plt.subplots_adjust(top=0.9)
-    hourly_vol_grid.fig.suptitle('Volume extracted in m3 (hourly)')
-    hourly_vol_grid.savefig(pp, format='pdf')
-    plt.close()
-    # Create bar plot ofhourly readings
-    hourly_report_grid = sns.FacetGrid(dataframe, col="Day", hue="Day",
-                         col_wrap=7, height=1.5)
-    # Draw a bar plot
-    hourly_report_grid.map(plt.bar, "Hour", "Readings")
-    # Adjust the arrangement of the plots
-    hourly_report_grid.fig.tight_layout(w_pad=1)
-    # Add title
-    plt.subplots_adjust(top=0.9)
-    hourly_report_grid.fig.suptitle('Meter readings received (hourly)')
-    # Export to pdf
-    hourly_report_grid.savefig(pp, format='pdf')
-    plt.close()
+    plot_hourly_grid(dataframe, 'Volume', 'Volume extracted in m3 (hourly)', pp)
+    # Create bar plot of hourly readings
+    plot_hourly_grid(dataframe, 'Readings', 'Meter readings received (hourly)', pp, bar=True)
     #Close pdf file
-    pp.close()      
+    pp.close()
 
 
 def main():
@@ -180,9 +204,14 @@ def main():
     end_date = dt.date.today()
     start_date_year = end_date - dt.timedelta(days = 365)
     start_date_month = end_date - dt.timedelta(days = 31)
+    # Request the yearly and monthly data concurrently, keeping plotting on the main thread
+    executor = ThreadPoolExecutor(max_workers=2)
+    year_request = executor.submit(get_volume_data, site, str(start_date_year), str(end_date))
+    month_request = executor.submit(get_volume_data, site, str(start_date_month), str(end_date))
+    executor.shutdown(wait=False)
     # Generate daily plots for the last year
     try:
-        vol_data = get_volume_data(site, str(start_date_year), str(end_date))
+        vol_data = year_request.result()
         daily_data = process_daily_data(vol_data, start_date_year, end_date)
         # Generate plots and output to pdf
         generate_daily_plots(site, daily_data)
@@ -191,7 +220,7 @@ def main():
         print("{0} has no data for the year ended {1}".format(site, end_date))
     # Generate hourly plots for the last month
     try:
-        vol_data2 = get_volume_data(site, str(start_date_month), str(end_date))
+        vol_data2 = month_request.result()
         hourly_data1 = process_hourly_data(vol_data2, start_date_month, end_date)
         hourly_data2 = add_missing_dates(hourly_data1, start_date_month, end_date)
         # Generate plots and output to pdf
@@ -13,7 +13,7 @@ two months.
 
 In order to run the program the user needs to:
 1. Have installed the hilltop-py package developed by Mike Exner-Kittridge
-2. Have installed the pandas and datetime modules (NB: these come packaged with
+2. Have installed the pandas, numpy, requests and datetime modules (NB: these come packaged with
 the Anaconda distribution of Python)
 3. Have the WAPReportingMode.csv saved in the same folder as this program.
 """
@@ -21,7 +21,22 @@ the Anaconda distribution of Python)
 
 from hilltoppy import web_service as ws
 import pandas as pd
+import numpy as np
 import datetime as dt
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+# Hilltop server details
+BASE_URL = 'http://wateruse.ecan.govt.nz'
+HTS = 'WaterUse.hts'
+MEASUREMENT = 'Compliance Volume'
+
+# Reuse one keep-alive HTTP session for every Hilltop request
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+ws.requests.get = SESSION.get
 
 
 def get_date():
@@ -39,25 +54,51 @@ def get_date():
 
 
 def get_volume_data(base_url, hts, site, measurement, from_date, to_date):
-    """Extracts compliance volume data from Hilltop for a given date range, and sums the reading counts for each day"""
+    """Extracts compliance volume data from Hilltop for a given date range"""
     tsdata = ws.get_data(base_url, hts, site, measurement, from_date, to_date)
     dfdata = tsdata.reset_index().drop(columns='Site').drop(columns='Measurement')
     return dfdata
 
 
-def transform_volume_data(dataframe, from_date, to_date):
-    """This function transforms the volume data to obtain daily totals"""
-    dataframe['Date'] = dataframe['DateTime'].dt.date
-    daily_counts = dataframe.groupby(['Date'])['Value'].agg(['count']).rename(columns={'count':'Readings'})
-    idx = pd.date_range(from_date, to_date)
+def fetch_volume_data(site, from_date, to_date):
+    """This function extracts compliance volume data for a single site. If no
+    data can be extracted the type of error is returned instead."""
+    print("Retrieving data for Site {0}".format(site))
+    try:
+        dfdata = get_volume_data(BASE_URL, HTS, site, MEASUREMENT, from_date, to_date)
+    except ValueError:
+        return 'Value error'
+    # Sometimes the web server throws a KeyError. Need to explore the cause of this.
+    except KeyError:
+        return 'Key error'
+    if dfdata.empty:
+        return 'Value error'
+    return dfdata
+
+
+def fetch_all_volume_data(sites, from_date, to_date):
+    """This function extracts compliance volume data for a list of sites
+    concurrently, returning a dictionary of the results for each site"""
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        results = executor.map(fetch_volume_data, sites, repeat(from_date), repeat(to_date))
+        return dict(zip(sites, results))
+
+
+def transform_volume_data(dataframe, sites, from_date, to_date):
+    """This function transforms the volume data to obtain daily totals for all
+    the sites in a single pass"""
+    dataframe['Date'] = dataframe['DateTime'].dt.floor('D')
+    daily_counts = dataframe.groupby(['Site', 'Date'], sort=False)['Value'].agg(['count']).rename(columns={'count':'Readings'})
+    idx = pd.MultiIndex.from_product([sites, pd.date_range(from_date, to_date)], names=['Site', 'Date'])
     daily_counts2 = daily_counts.reindex(idx, fill_value=0)
     return daily_counts2
 
 
 def main():
     """This function controls the execution of the main program"""
-    # Get reporting modes
-    wap_modes = pd.read_csv('WAPReportingMode.csv')
+    # Get reporting modes, reading Mode as numeric so blank or unparseable modes become NaN
+    wap_modes = pd.read_csv('WAPReportingMode.csv', usecols=['Site', 'Mode'], dtype={'Site': str})
+    wap_modes['Mode'] = pd.to_numeric(wap_modes['Mode'], errors='coerce')
     
     ################################
     # Restrict to a subset of sites
@@ -72,64 +113,61 @@ def main():
     end_date = user_date + dt.timedelta(days = 1)
     week_start = end_date - dt.timedelta(days = 7)
     year_start = end_date - dt.timedelta(days = 365)
-    # Open output file
-    outfile = open("Missing Data Report - Week ending {}.csv".format(str(user_date)), "w")
-    outfile.write("Site,Mode,PercComplete,LastReport\n")
-    # Iterate through site list
-    i = 1
-    for index, row in df.iterrows(): 
-        site = row["Site"]
-        mode = row["Mode"]
-        base_url = 'http://wateruse.ecan.govt.nz'
-        hts = 'WaterUse.hts'        
-        measurement = 'Compliance Volume'
-        print("Retrieving data for Site {0} - {1}".format(i,site))
-        # Try extracting data for the last week
-        try:
-            week_data = get_volume_data(base_url, hts, site, measurement, str(week_start), str(end_date))
-            daily_counts = transform_volume_data(week_data, str(week_start), str(end_date))
-            if int(mode) > 0:
-                weekly_total = daily_counts['Readings'].sum() - 1
-                expected = int(mode) * 7
-                perc_complete = round(weekly_total / expected * 100, 1)
-                last_report = max(week_data['DateTime'])
-                result = "{0},{1},{2},{3}\n".format(site, mode, perc_complete, last_report)
-                outfile.write(result)
-                i += 1
-            elif int(mode) == 0:
-                last_report = max(week_data['DateTime'])
-                result = "{0},{1},Mode equals 0!,{2}\n".format(site, mode, last_report)
-                outfile.write(result)
-                i += 1
-            elif mode == "No data":
-                last_report = max(week_data['DateTime'])
-                result = "{0},No mode data,Unknown,{1}\n".format(site, last_report)
-                outfile.write(result)
-                i += 1                  
-        # If there is no data in the last week, extract data for the last year to ascertain when data was last received
-        except ValueError:
-            try:
-                annual_data = get_volume_data(base_url, hts, site, measurement, str(year_start), str(end_date))
-                last_report = max(annual_data['DateTime'])
-                result = "{0},{1},No data in last week,{2}\n".format(site, mode,last_report)
-                outfile.write(result)
-                i += 1
-            # This except clause deals with the situation where there is no data for the last year
-            except ValueError:
-                result = "{0},{1},Value error,Unknown\n".format(site, mode)
-                outfile.write(result)
-                i += 1                
-            # Sometimes the web server throws a KeyError. Need to explore the cause of this.
-            except KeyError:
-                result = "{0},{1},Key error,Unknown\n".format(site, mode)
-                outfile.write(result)
-                i += 1             
-        # Sometimes the web server throws a KeyError. Need to explore the cause of this.
-        except KeyError:
-            result = "{0},{1},Key error,Unknown\n".format(site, mode)
-            outfile.write(result)
-            i += 1
-    # Close output file
-    outfile.close()
-
-main()   
\ No newline at end of file
+    # Extract data for the last week for all sites
+    sites = df['Site'].tolist()
+    week_results = fetch_all_volume_data(sites, str(week_start), str(end_date))
+    week_sites = [site for site in sites if isinstance(week_results[site], pd.DataFrame)]
+    # If there is no data in the last week, extract data for the last year to ascertain when data was last received
+    missing_sites = [site for site, result in week_results.items()
+                     if isinstance(result, str) and result == 'Value error']
+    annual_results = fetch_all_volume_data(missing_sites, str(year_start), str(end_date))
+    # Summarise the weekly data for all sites at once
+    if week_sites:
+        week_data = pd.concat([week_results[site] for site in week_sites], keys=week_sites,
+                              names=['Site', None], copy=False).reset_index(level='Site')
+        daily_counts = transform_volume_data(week_data, week_sites, str(week_start), str(end_date))
+        weekly_totals = daily_counts['Readings'].groupby(level='Site', sort=False).sum() - 1
+        last_reports = week_data.groupby('Site', sort=False)['DateTime'].max()
+    # Iterate through site list, filling preallocated result columns for each site
+    n = len(df)
+    # Write whole-number modes without a trailing .0 and leave missing modes blank
+    modes = np.array([None if pd.isna(mode) else int(mode) for mode in df['Mode']], dtype=object)
+    perc_completes = np.empty(n, dtype=object)
+    last_reports_out = np.empty(n, dtype=object)
+    reported = np.ones(n, dtype=bool)
+    for i, row in enumerate(df.itertuples(index=False)):
+        site = row.Site
+        mode = row.Mode
+        week_result = week_results[site]
+        if isinstance(week_result, pd.DataFrame):
+            last_reports_out[i] = last_reports[site]
+            if pd.isna(mode):
+                modes[i] = 'No mode data'
+                perc_completes[i] = 'Unknown'
+            elif mode == 0:
+                perc_completes[i] = 'Mode equals 0!'
+            elif mode > 0:
+                weekly_total = weekly_totals[site]
+                expected = mode * 7
+                perc_completes[i] = round(weekly_total / expected * 100, 1)
+            else:
+                reported[i] = False
+        elif week_result == 'Value error':
+            annual_result = annual_results[site]
+            if isinstance(annual_result, pd.DataFrame):
+                last_reports_out[i] = max(annual_result['DateTime'])
+                perc_completes[i] = 'No data in last week'
+            # This deals with the situation where there is no data for the last year
+            else:
+                perc_completes[i] = annual_result
+                last_reports_out[i] = 'Unknown'
+        else:
+            perc_completes[i] = week_result
+            last_reports_out[i] = 'Unknown'
+    # Write the output file in one go
+    report = pd.DataFrame({'Site': df['Site'].to_numpy(), 'Mode': modes,
+                           'PercComplete': perc_completes, 'LastReport': last_reports_out})
+    report = report.loc[reported]
+    report.to_csv("Missing Data Report - Week ending {}.csv".format(str(user_date)), index=False)
+
+main()
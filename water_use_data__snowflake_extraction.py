@@ -8,9 +8,12 @@ Created on Thu Feb 17 11:19:01 2022
 #import packages
 import snowflake.connector
 import matplotlib.pyplot as plt
-import pandas as pd
 import os
 import csv
+import json
+import gzip
+import shutil
+from datetime import date
 
 #change these inputs
 
@@ -21,7 +24,11 @@ user1 = 'hamish.graham@ecan.govt.nz'
 data_Output_path = r'C:\Users\hamishg.CH\OneDrive - Environment Canterbury\Documents\_Projects\Data extraction\Water Use\Rangitata\rangitata_data.csv'
 meter_name = r'C:\Users\hamishg.CH\OneDrive - Environment Canterbury\Documents\_Projects\Data extraction\Water Use\Rangitata\waps.csv'
 
-#import meter list from csv and convert to string
+#first and last dates of the extraction (YYYY-MM-DD). Narrowing these lets Snowflake skip the older data entirely
+start_date = '1900-01-01'
+end_date = str(date.today())
+
+#import meter list from csv
 site_list = []
 with open(meter_name, newline='') as f:
     for row in csv.reader(f):
@@ -29,8 +36,8 @@ with open(meter_name, newline='') as f:
 
    
 
-site_list_str = ','.join(map("'{0}'".format, site_list))
-site_list_str = '('+site_list_str+')'
+#bind the meter list as a single JSON array, which the connector escapes, rather than splicing quoted names into the SQL
+site_list_json = json.dumps(site_list)
 #Snowflake connection
 ctx = snowflake.connector.connect(
 user = user1,
@@ -44,8 +51,8 @@ warehouse='USERS_PROD_WH'
 #create a cursor object
 cs = ctx.cursor()
 
-#send a SQL query to Snowflake that sums 15 min data into daily data. Also group by Attribute Name, DataSource etc so data from different sources isnt summed together.
-cs.execute('''
+#SQL query that sums 15 min data into daily data. Also group by Attribute Name, DataSource etc so data from different sources isnt summed together.
+query = '''
     WITH TYPE_CORRECTED_COMBINED_METERS AS (
         SELECT "SiteId", "AttributeName", "UnitName", "HydroYear", "DataSource", "ObservationValue", "ObservationDateTime",
         //create a new column called "PrevObservationValue" for the abstraction recorded in the previous timestep
@@ -69,7 +76,10 @@ cs.execute('''
         
         FROM "WATERDATAREPO_PROD"."hill"."WaterAbstractionObservations"
 
-        WHERE "SiteId" IN ''' + site_list_str + '''
+        //filter on the date range in the base scan so Snowflake can prune partitions. The start is padded back a month
+        //so the first readings in the range still have a previous reading to difference against
+        WHERE "SiteId" IN (SELECT VALUE::STRING FROM TABLE(FLATTEN(INPUT => PARSE_JSON(%(sites)s))))
+            AND "ObservationDateTime" >= DATEADD(day, -31, %(start)s::DATE) AND "ObservationDateTime" < DATEADD(day, 1, %(end)s::DATE)
     ),
 
         //Sum the abstraction volume for each site, date, and data source
@@ -78,7 +88,8 @@ cs.execute('''
             FROM (
                 SELECT MeasuredValue, "DataSource", "SiteId", TO_DATE("ObservationDateTime") AS DATE
                 FROM TYPE_CORRECTED_COMBINED_METERS
-                WHERE MeasuredValue >= 0
+                //apply the exact start of the date range now the previous readings have been used
+                WHERE MeasuredValue >= 0 AND "ObservationDateTime" >= %(start)s::DATE
                 )
             GROUP BY "SiteId", DATE, "DataSource"
     ), 
@@ -97,9 +108,18 @@ INNER JOIN NUMBER_OF_DATASOURCES NOD
     ON NOD."SiteId" = DDS."SiteId" AND NOD.DATE = DDS.DATE
 ORDER BY "SiteId", DATE
 
-    ''')           
-        
-#convert the returned query result into a dataframe
-abstraction_dataM = cs.fetch_pandas_all()
-
-abstraction_dataM.to_csv(data_Output_path)
\ No newline at end of file
+    '''
+
+#have Snowflake write the query result straight to a single gzipped csv on the user stage, skipping pandas entirely
+stage_file = "'@~/water_use_extraction/" + os.path.basename(data_Output_path) + ".gz'"
+cs.execute('COPY INTO ' + stage_file + ' FROM (' + query + ''')
+    FILE_FORMAT = (TYPE = CSV COMPRESSION = GZIP FIELD_OPTIONALLY_ENCLOSED_BY = '"' NULL_IF = ())
+    SINGLE = TRUE HEADER = TRUE OVERWRITE = TRUE MAX_FILE_SIZE = 5368709120''', {'sites': site_list_json, 'start': start_date, 'end': end_date})
+
+#download the file from the stage and unzip it to the output path
+output_dir = os.path.dirname(data_Output_path).replace('\\', '/')
+cs.execute("GET " + stage_file + " 'file://" + output_dir + "/'")
+cs.execute('REMOVE ' + stage_file)
+with gzip.open(data_Output_path + '.gz', 'rb') as zipped_file, open(data_Output_path, 'wb') as output_file:
+    shutil.copyfileobj(zipped_file, output_file)
+os.remove(data_Output_path + '.gz')